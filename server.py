@@ -1,10 +1,36 @@
 import os, json, time
+import re
+import random
+import asyncio
+import contextlib
+import functools
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows - connection.json writes are not locked
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # optional - Sheets responses are parsed with stdlib json instead
+    orjson = None
 
 import gspread
+import httplib2
+import google_auth_httplib2
 from google.oauth2.credentials import Credentials
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from googleapiclient.model import JsonModel
 from cryptography.fernet import Fernet
 
 from fastmcp import FastMCP
@@ -29,11 +55,55 @@ logging.getLogger("mcp.server").setLevel(logging.DEBUG)
 logging.getLogger("fastmcp").setLevel(logging.DEBUG)
 
 CLIENT_SECRET_FILE = os.path.join(os.path.dirname(__file__), "google_client_secret.json")
-with open(CLIENT_SECRET_FILE, 'r') as f:
-    client_secrets = json.load(f)
 
-GOOGLE_CLIENT_ID = client_secrets["web"]["client_id"]
-GOOGLE_CLIENT_SECRET = client_secrets["web"]["client_secret"]
+@functools.cache
+def _client_secrets():
+    """Read google_client_secret.json once, only when env vars don't supply the values."""
+    with open(CLIENT_SECRET_FILE, 'r') as f:
+        return json.load(f)["web"]
+
+GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID") or _client_secrets()["client_id"]
+GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET") or _client_secrets()["client_secret"]
+
+@contextlib.asynccontextmanager
+async def _warm_up():
+    """
+    Build the Sheets service (token refresh + discovery) in the background at
+    startup so the first tool call doesn't pay for it, then keep its access
+    token refreshed ahead of expiry. Runs once per process from the HTTP app's
+    lifespan (the FastMCP server lifespan can run once per session).
+    """
+    # Tool bodies run via asyncio.to_thread on the loop's default executor, which
+    # is only min(32, CPUs + 4) threads - size it so bursts of calls don't queue
+    loop = asyncio.get_running_loop()
+    replaced = getattr(loop, "_default_executor", None)
+    executor = ThreadPoolExecutor(max_workers=TOOL_THREADS, thread_name_prefix="tool")
+    loop.set_default_executor(executor)
+    if replaced is not None:
+        replaced.shutdown(wait=False)
+    
+    async def warm():
+        # File read + token decryption are blocking - keep them off the event loop
+        conn = await asyncio.to_thread(load_connection)
+        if conn and conn.get("refresh_token"):
+            try:
+                await asyncio.to_thread(sheets_service_for, conn["refresh_token"])
+                logger.info("Google Sheets service ready")
+            except Exception as e:
+                logger.warning(f"Could not pre-build Sheets service: {e}")
+    
+    async def keep_tokens_fresh():
+        while True:
+            await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+            await asyncio.to_thread(_refresh_expiring_credentials)
+    
+    tasks = [asyncio.create_task(warm()), asyncio.create_task(keep_tokens_fresh())]
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False)
 
 mcp = FastMCP(
     name="Google Sheets MCP",
@@ -44,8 +114,86 @@ mcp = FastMCP(
 CONN_FILE = os.path.join(os.path.dirname(__file__), "connection.json")
 FERNET_KEY = os.getenv("FERNET_KEY")
 
+# Recently processed order keys (oldest first) used to drop duplicate retries
+_RECENT_TTL = 30
+_RECENT_MAX = 1024
+_recent_orders: "OrderedDict[bytes, float]" = OrderedDict()
+_RECENT_LOCK = threading.Lock()
+# Order errors returned before any write is attempted
+_ORDER_REJECTED_ERRORS = frozenset({
+    "no_connection_configured", "missing_configuration", "product_not_found",
+    "insufficient_stock", "missing_customer_information"
+})
+
+# Emoji order summaries in tool responses; set MCP_INCLUDE_SUMMARY=0 when the
+# client formats its own reply from the structured fields
+INCLUDE_SUMMARY = os.getenv("MCP_INCLUDE_SUMMARY", "1") == "1"
+
+_CANCEL_SUMMARY_TMPL = (
+    "\n❌ ORDER CANCELLED SUCCESSFULLY!\n"
+    "\n"
+    "🆔 Cancelled Order: {order_id}\n"
+    "📦 Product: {product}\n"
+    "🔢 Quantity: {qty}\n"
+    "👤 Customer: {customer}\n"
+    "\n"
+    "✅ Order marked as 'Cancelled' and {qty} units restored to inventory!\n"
+    "📋 Order preserved for business records."
+)
+
+# Short-lived cache of parsed sheet data keyed by (workbook_id, worksheet_name).
+# Our own writes invalidate it; edits made directly in Sheets show up within the TTL.
+# It only serves read-only queries - the order/update/cancel tools always read
+# fresh data, since stock computed from a stale snapshot would overwrite newer writes.
+SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL", "10"))
+_SHEET_CACHE = {}
+_SHEET_CACHE_LOCK = threading.Lock()
+# Bumped by every invalidation; a read that started before the bump must not
+# store its (possibly pre-write) result
+_sheet_cache_generation = 0
+
+# Shared pool for overlapping independent Sheets calls (reads of two sheets,
+# writes to two workbooks)
+_SHEETS_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sheets-io")
+_thread_local = threading.local()
+# Threads available to tool calls (asyncio.to_thread) in each server process
+TOOL_THREADS = int(os.getenv("TOOL_THREADS", "32"))
+# Socket timeout for Sheets API connections (httplib2 waits forever by default)
+SHEETS_HTTP_TIMEOUT = float(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+
+# Sheets services and the credentials behind them, keyed by refresh token. A
+# background task refreshes the credentials before expiry so tool calls never
+# wait on the token endpoint.
+_SERVICES_MAX = 32
+_services = {}
+_SERVICES_LOCK = threading.Lock()
+_live_credentials = {}
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+TOKEN_REFRESH_INTERVAL = 60
+# One transport (requests.Session) for all token refreshes, so the connection to
+# the token endpoint is kept alive instead of re-handshaking on every refresh
+_TOKEN_REQUEST = Request()
+
+# Client-side limits for Sheets API calls: at most SHEETS_MAX_CONCURRENT in flight,
+# started no faster than SHEETS_RPS per second, with backoff on quota/transient errors
+SHEETS_MAX_CONCURRENT = int(os.getenv("SHEETS_MAX_CONCURRENT", "4"))
+SHEETS_RPS = float(os.getenv("SHEETS_RPS", "5"))
+SHEETS_MAX_RETRIES = 3
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_SHEETS_SEMAPHORE = threading.BoundedSemaphore(SHEETS_MAX_CONCURRENT)
+_rate_lock = threading.Lock()
+_next_call_at = 0.0
+
+# Circuit breaker: after _BREAKER_FAIL_MAX calls in a row fail with 429/5xx even
+# after retries, fail fast for _BREAKER_RESET seconds instead of queueing more
+_BREAKER_FAIL_MAX = 5
+_BREAKER_RESET = 30
+_breaker_lock = threading.Lock()
+_breaker_failures = 0
+_breaker_open_until = 0.0
+
 def decrypt_if_needed(token_enc: str) -> str:
-    logger.debug(f"Decrypting token... FERNET_KEY exists: {bool(FERNET_KEY)}")
+    logger.debug("Decrypting token... FERNET_KEY exists: %s", bool(FERNET_KEY))
     if not token_enc:
         logger.error("No token provided for decryption")
         return None
@@ -53,22 +201,41 @@ def decrypt_if_needed(token_enc: str) -> str:
     logger.debug("Encryption disabled, returning token as-is")
     return token_enc
 
+# (file mtime/size, parsed connection data) from the last load_connection()
+_conn_cache = None
+
 def load_connection():
     """
     Load connection data from simple connection.json file.
+    The parsed (and decrypted) result is reused until the file changes on disk.
     """
-    logger.debug(f"Loading connection from: {CONN_FILE}")
-    
-    if not os.path.exists(CONN_FILE):
+    global _conn_cache
+    try:
+        stat = os.stat(CONN_FILE)
+    except OSError:
         logger.error(f"Connection file does not exist: {CONN_FILE}")
         logger.info(f"Please create {CONN_FILE} with your Google Sheets configuration")
         return None
     
+    file_key = (stat.st_mtime_ns, stat.st_size)
+    cached = _conn_cache
+    if cached is not None and cached[0] == file_key:
+        return cached[1]
+    
+    data = _read_connection_file()
+    if data is not None:
+        _conn_cache = (file_key, data)
+    return data
+
+def _read_connection_file():
+    """Parse connection.json, converting the old single-sheet format"""
+    logger.debug("Loading connection from: %s", CONN_FILE)
+    
     logger.debug("Connection file exists, loading...")
     try:
         with open(CONN_FILE, "r") as f:
             data = json.load(f)
-        logger.debug(f"Connection file loaded successfully. Keys: {list(data.keys())}")
+        logger.debug("Connection file loaded successfully. Keys: %s", list(data.keys()))
         
         # Handle both old and new format
         if "inventory" in data and "orders" in data:
@@ -100,17 +267,64 @@ def load_connection():
         logger.error(f"Failed to load connection file: {e}")
         return None
 
+def _build_request(http, *args, **kwargs):
+    """
+    Build each API request on a per-thread httplib2 connection.
+    httplib2.Http is not thread-safe, so calls issued from _SHEETS_EXECUTOR
+    must not share the service's default connection. Each thread's connection
+    is kept alive and reused across calls.
+    """
+    thread_http = getattr(_thread_local, "http", None)
+    if thread_http is None:
+        thread_http = _thread_local.http = httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT)
+    # Reuse this thread's authorized wrapper while the credentials stay the same
+    authed = getattr(_thread_local, "authed", None)
+    if authed is None or authed[0] is not http.credentials:
+        authed = _thread_local.authed = (
+            http.credentials,
+            google_auth_httplib2.AuthorizedHttp(http.credentials, http=thread_http)
+        )
+    return HttpRequest(authed[1], *args, **kwargs)
+
+class _OrjsonModel(JsonModel):
+    """googleapiclient response model that parses response bodies with orjson"""
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and isinstance(body, dict) and "data" in body:
+            body = body["data"]
+        return body
+
+class _SharedCredentials(Credentials):
+    """
+    Credentials shared by the tool threads and the background refresher. Refreshes
+    are serialized, and a caller that waited while another thread refreshed keeps
+    the new token instead of refreshing again.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._refresh_lock = threading.Lock()
+    
+    def refresh(self, request):
+        stale_token = self.token
+        with self._refresh_lock:
+            if self.token != stale_token and self.valid:
+                return
+            super().refresh(request)
+
 def build_sheets_service_from_refresh(refresh_token):
     logger.debug("Building credentials from refresh token...")
-    logger.debug(f"Client ID: {GOOGLE_CLIENT_ID}")
-    logger.debug(f"Client Secret exists: {bool(GOOGLE_CLIENT_SECRET)}")
+    logger.debug("Client ID: %s", GOOGLE_CLIENT_ID)
+    logger.debug("Client Secret exists: %s", bool(GOOGLE_CLIENT_SECRET))
     
     # Decrypt the refresh token if needed
     decrypted_token = decrypt_if_needed(refresh_token)
-    logger.debug(f"Token decrypted successfully: {bool(decrypted_token)}")
-    logger.debug(f"Decrypted token length: {len(decrypted_token) if decrypted_token else 0}")
+    logger.debug("Token decrypted successfully: %s", bool(decrypted_token))
+    logger.debug("Decrypted token length: %s", len(decrypted_token) if decrypted_token else 0)
     
-    creds = Credentials(
+    creds = _SharedCredentials(
         token=None,
         refresh_token=decrypted_token,
         token_uri="https://oauth2.googleapis.com/token",
@@ -122,296 +336,931 @@ def build_sheets_service_from_refresh(refresh_token):
     
     try:
         # refresh to get an access token
-        creds.refresh(Request())
-        print("[DEBUG] Token refresh successful!")
-        print(f"[DEBUG] Access token exists: {bool(creds.token)}")
+        creds.refresh(_TOKEN_REQUEST)
+        logger.debug("Token refresh successful!")
+        logger.debug("Access token exists: %s", bool(creds.token))
+        _live_credentials[refresh_token] = creds
     except Exception as refresh_error:
-        print(f"[ERROR] Token refresh failed: {refresh_error}")
+        logger.error("Token refresh failed: %s", refresh_error)
         raise
     
-    print("[DEBUG] Building Google Sheets service...")
-    service = build("sheets", "v4", credentials=creds)
-    print("[DEBUG] Google Sheets service built successfully")
+    logger.debug("Building Google Sheets service...")
+    # The bundled (static) discovery document is used, so skip the discovery file cache
+    service = build(
+        "sheets", "v4",
+        credentials=creds,
+        requestBuilder=_build_request,
+        cache_discovery=False,
+        static_discovery=True,
+        model=_OrjsonModel() if orjson else None
+    )
+    logger.debug("Google Sheets service built successfully")
     return service
 
-def smart_column_detection(data_row, column_type):
+def _refresh_expiring_credentials():
+    """Refresh cached credentials whose access token expires within TOKEN_REFRESH_MARGIN"""
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) + TOKEN_REFRESH_MARGIN
+    for refresh_token, creds in list(_live_credentials.items()):
+        if creds.expiry is None or creds.expiry <= cutoff:
+            try:
+                creds.refresh(_TOKEN_REQUEST)
+                logger.debug("Refreshed access token, now valid until %s", creds.expiry)
+            except RefreshError as e:
+                # Revoked/expired refresh token: drop its cached service so the next
+                # tool call rebuilds it (and reports the auth error) instead of reusing it
+                logger.warning(f"Refresh token rejected, dropping cached service: {e}")
+                with _SERVICES_LOCK:
+                    # Unless the service was rebuilt meanwhile
+                    if _live_credentials.get(refresh_token) is creds:
+                        _live_credentials.pop(refresh_token)
+                        _services.pop(refresh_token, None)
+            except Exception as e:
+                logger.warning(f"Background token refresh failed: {e}")
+
+def sheets_service_for(refresh_token):
     """
-    Intelligently detect columns based on common business terminology.
-    Supports various business types: fashion, beauty, electronics, etc.
+    Sheets service per refresh token, built once and reused across tool calls.
+    Requests run on per-thread connections (_build_request) and the credentials
+    refresh themselves when the access token expires.
     """
-    column_mappings = {
-        "product_name": [
-            "item_name", "product_name", "product_title", "name", "product", "title", 
-            "merchandise", "article", "sku_name"
-        ],
-        "quantity": [
-            "quantity", "qty", "stock", "available", "inventory", "count",
-            "units", "pieces", "amount", "availability", "in_stock"
-        ],
-        "price": [
-            "unit_price", "price", "cost", "amount", "rate", "selling_price",
-            "retail_price", "mrp", "value", "pkr", "usd", "inr"
-        ],
-        "id": [
-            "item_id", "product_id", "id", "sku", "code", "barcode",
-            "item_code", "product_code", "order_no", "order_id", "orderid"
-        ],
-        "status": [
-            "status", "availability", "available", "active", "enabled",
-            "payment_status", "order_status", "stock_status"
-        ],
-        "size": [
-            "size", "dimensions", "variant", "option", "type"
-        ],
-        "color": [
-            "color", "colour", "shade", "variant"
-        ],
-        "weight": [
-            "weight", "mass", "volume", "ml", "grams", "kg", "oz"
-        ]
-    }
+    service = _services.get(refresh_token)
+    if service is None:
+        with _SERVICES_LOCK:
+            service = _services.get(refresh_token)
+            if service is not None:
+                return service
+            service = _services[refresh_token] = build_sheets_service_from_refresh(refresh_token)
+            if len(_services) > _SERVICES_MAX:
+                # Oldest first (insertion order)
+                evicted = next(iter(_services))
+                _services.pop(evicted)
+                _live_credentials.pop(evicted, None)
+    return service
+
+# Column type -> header names that identify it, most specific first
+_COLUMN_MAPPINGS = {
+    "product_name": [
+        "item_name", "product_name", "product_title", "name", "product", "title", 
+        "merchandise", "article", "sku_name"
+    ],
+    "quantity": [
+        "quantity", "qty", "stock", "available", "inventory", "count",
+        "units", "pieces", "amount", "availability", "in_stock"
+    ],
+    "price": [
+        "unit_price", "price", "cost", "amount", "rate", "selling_price",
+        "retail_price", "mrp", "value", "pkr", "usd", "inr"
+    ],
+    "id": [
+        "item_id", "product_id", "id", "sku", "code", "barcode",
+        "item_code", "product_code", "order_no", "order_id", "orderid"
+    ],
+    "status": [
+        "status", "availability", "available", "active", "enabled",
+        "payment_status", "order_status", "stock_status"
+    ],
+    "size": [
+        "size", "dimensions", "variant", "option", "type"
+    ],
+    "color": [
+        "color", "colour", "shade", "variant"
+    ],
+    "weight": [
+        "weight", "mass", "volume", "ml", "grams", "kg", "oz"
+    ]
+}
+
+# Exact header name -> the column types it names (a few names, e.g. "amount", map to two)
+_EXACT_COLUMN_TYPES = {}
+for _col_type, _names in _COLUMN_MAPPINGS.items():
+    for _name in _names:
+        _EXACT_COLUMN_TYPES.setdefault(_name, []).append(_col_type)
+
+# Partial match: a known name as a whole "_"-separated part of the header (prefix, suffix or middle)
+_PARTIAL_COLUMN_PATTERNS = {
+    col_type: re.compile(r"(?:^|_)(?:" + "|".join(map(re.escape, names)) + r")(?:_|$)").search
+    for col_type, names in _COLUMN_MAPPINGS.items()
+}
+
+_CLEAN_KEY_TABLE = str.maketrans({" ": "_", "-": "_", "(": None, ")": None})
+
+@functools.lru_cache(maxsize=256)
+def _detect_columns(keys, column_type):
+    """
+    Intelligently detect columns based on common business terminology (fashion,
+    beauty, electronics, ...): work out which header supplies each column type.
+    Depends only on the header names, so it is memoized per header tuple.
+    Returns ((col_type, key, clean_key), ...), partial matches first.
+    """
+    clean_keys = [str(key).strip().lower().translate(_CLEAN_KEY_TABLE) for key in keys]
+    wanted = lambda col_type: column_type == "all" or column_type == col_type
     
-    result = {}
+    # First pass: collect all exact matches (highest priority), first header wins
     exact_matches = {}
+    for key, clean_key in zip(keys, clean_keys):
+        for col_type in _EXACT_COLUMN_TYPES.get(clean_key, ()):
+            if wanted(col_type) and col_type not in exact_matches:
+                exact_matches[col_type] = (col_type, key, clean_key)
     
-    # First pass: collect all exact matches (highest priority)
-    for key, value in data_row.items():
-        clean_key = str(key).strip().lower().replace(' ', '_').replace('-', '_').replace('(', '').replace(')', '')
-        
-        for col_type, possible_names in column_mappings.items():
-            if column_type == "all" or column_type == col_type:
-                for possible_name in possible_names:
-                    # Exact match - highest priority
-                    if clean_key == possible_name:
-                        if col_type not in exact_matches:  # Take first exact match
-                            exact_matches[col_type] = {"key": key, "value": value, "clean_key": clean_key}
-                        break
+    # Second pass: partial matches only for column types without an exact match
+    partial_matches = {}
+    for key, clean_key in zip(keys, clean_keys):
+        for col_type, matches in _PARTIAL_COLUMN_PATTERNS.items():
+            if wanted(col_type) and col_type not in exact_matches \
+                    and col_type not in partial_matches and matches(clean_key):
+                partial_matches[col_type] = (col_type, key, clean_key)
     
-    # Second pass: partial matches only if no exact match found
-    for key, value in data_row.items():
-        clean_key = str(key).strip().lower().replace(' ', '_').replace('-', '_').replace('(', '').replace(')', '')
-        
-        for col_type, possible_names in column_mappings.items():
-            if column_type == "all" or column_type == col_type:
-                # Skip if we already have an exact match for this column type
-                if col_type in exact_matches:
-                    continue
-                    
-                for possible_name in possible_names:
-                    # Partial match patterns
-                    if (clean_key.startswith(possible_name + '_') or
-                        clean_key.endswith('_' + possible_name) or
-                        ('_' + possible_name + '_' in clean_key)):
-                        if col_type not in result:  # Take first partial match
-                            result[col_type] = {"key": key, "value": value, "clean_key": clean_key}
-                        break
-    
-    # Combine exact matches and partial matches
-    result.update(exact_matches)
+    return tuple(partial_matches.values()) + tuple(exact_matches.values())
+
+def _cell_to_str(cell_value):
+    """Normalize an UNFORMATTED_VALUE cell to the string form used in row dicts."""
+    if isinstance(cell_value, str):
+        # strip() hands back the same object when there is nothing to trim
+        return cell_value.strip()
+    if cell_value is None:
+        return ""
+    return str(cell_value)
+
+# Orders-sheet header words mapped to the order field that fills them, highest
+# priority first, so when a header names two fields the more specific one wins:
+# "Email Address" -> email, "Product Price" / "Total Price" -> price / subtotal,
+# "Order Status" -> status. Headers are matched on whole words first, splitting on
+# punctuation and camelCase ("UnitPrice", "Qty.", "Price(PKR)").
+_ORDER_FIELD_WORDS = (
+    ("customer_email", ("email", "mail")),
+    ("subtotal", ("subtotal", "total")),
+    ("price", ("price", "cost")),
+    ("quantity", ("quantity", "qty")),
+    ("status", ("status",)),
+    ("customer_address", ("address",)),
+    ("payment_mode", ("payment",)),
+    ("notes", ("notes", "note")),
+    ("size", ("size",)),
+    ("color", ("color", "colour")),
+    ("category", ("category",)),
+    ("weight", ("weight",)),
+    ("description", ("description",)),
+)
+
+# Qualifier words only name a field when the rest of the header is an identifier
+# word ("Customer Name", "Product", "Order No"), so columns such as "Customer Phone",
+# "Delivery Date" or "Order Date" are left empty instead of getting a wrong value
+_ORDER_FIELD_QUALIFIERS = (
+    ("customer_address", ("delivery",)),
+    ("payment_mode", ("mode",)),
+    ("customer_name", ("customer",)),
+    ("product_name", ("product", "item")),
+    ("order_id", ("order",)),
+)
+_IDENTIFIER_WORDS = frozenset({"name", "title", "id", "no", "number", "num", "#"})
+
+_HEADER_WORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+|#")
+
+# Compound fallback for headers that run words together ("orderid", "customeremail"):
+# field needles in priority order, longest needle first within a field
+_ORDER_FIELD_COMPOUNDS = tuple(
+    (field, tuple(sorted(needles, key=len, reverse=True))) for field, needles in _ORDER_FIELD_WORDS
+)
+_QUALIFIER_COMPOUNDS = tuple(sorted(
+    ((needle, field) for field, needles in _ORDER_FIELD_QUALIFIERS for needle in needles),
+    key=lambda pair: len(pair[0]), reverse=True,
+))
+
+@functools.lru_cache(maxsize=256)
+def _header_field(header):
+    """The order field that fills an orders header, or None if it stays empty"""
+    words = [word.lower() for word in _HEADER_WORD.findall(str(header))]
+    for field, needles in _ORDER_FIELD_WORDS:
+        if any(word in needles for word in words):
+            return field
+    for field, needles in _ORDER_FIELD_QUALIFIERS:
+        for i, word in enumerate(words):
+            if word in needles and all(other in _IDENTIFIER_WORDS for j, other in enumerate(words) if j != i):
+                return field
+    compound = "".join(words)
+    for field, needles in _ORDER_FIELD_COMPOUNDS:
+        if any(needle in compound for needle in needles):
+            return field
+    for needle, field in _QUALIFIER_COMPOUNDS:
+        head, found, tail = compound.partition(needle)
+        if found and (head + tail == "" or head + tail in _IDENTIFIER_WORDS):
+            return field
+    return None
+
+@functools.lru_cache(maxsize=16)
+def _orders_row_plan(headers):
+    """_header_field for each orders header, resolved once per orders-sheet schema"""
+    return tuple(_header_field(header) for header in headers)
+
+class _NumericFilter(dict):
+    """str.translate table that keeps only ASCII digits and '.', filled in lazily."""
+    def __missing__(self, codepoint):
+        keep = codepoint if chr(codepoint) in "0123456789." else None
+        self[codepoint] = keep
+        return keep
+
+_PRICE_TABLE = _NumericFilter()
+
+# A dot straight after a letter ends an abbreviation ('Rs. 1,200'), it isn't a decimal point
+_ABBREVIATION_DOT = re.compile(r"(?<=[^\W\d_])\.")
+# A '-' before the first digit makes the price negative ('-5', 'PKR -5')
+_LEADING_MINUS = re.compile(r"[^\d-]*-")
+
+def parse_price(value):
+    """Extract a numeric unit price from cells like 'PKR 1,200'; None if there isn't one."""
+    text = _ABBREVIATION_DOT.sub("", str(value))
+    last_dot = text.rfind(".")
+    if last_dot != -1 and text.rfind(",") > last_dot:
+        # Comma-decimal format ('1.200,50'): dots group thousands
+        text = text.replace(".", "").replace(",", ".")
+    price_numeric = text.translate(_PRICE_TABLE)
+    if not price_numeric:
+        return None
+    try:
+        price = float(price_numeric)
+    except ValueError:
+        return None
+    return -price if _LEADING_MINUS.match(text) else price
+
+def _persist_sheet_ids(sheet_ids):
+    """
+    Write resolved numeric sheetIds, keyed by (workbook_id, worksheet_name), back
+    into connection.json. Locked + os.replace so concurrent workers can't
+    interleave or leave a half-written file.
+    """
+    lock_file = open(CONN_FILE + ".lock", "w")
+    try:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with open(CONN_FILE, "r") as f:
+            data = json.load(f)
+        changed = False
+        for section in ("inventory", "orders"):
+            config = data.get(section)
+            if not isinstance(config, dict):
+                continue
+            sheet_id = sheet_ids.get((config.get("workbook_id"), config.get("worksheet_name")))
+            if sheet_id is not None and config.get("sheet_id_numeric") != sheet_id:
+                config["sheet_id_numeric"] = sheet_id
+                config["sheet_id_title"] = config["worksheet_name"]
+                changed = True
+        if changed:
+            tmp_file = CONN_FILE + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_file, CONN_FILE)
+            logger.debug("Saved numeric sheet ids to connection file")
+    except Exception as e:
+        logger.warning(f"Could not save sheet ids to connection file: {e}")
+    finally:
+        lock_file.close()
+
+def _wait_for_rate_slot():
+    """Space out call starts so we stay under SHEETS_RPS"""
+    global _next_call_at
+    if SHEETS_RPS <= 0:
+        return
+    with _rate_lock:
+        now = time.monotonic()
+        start_at = max(now, _next_call_at)
+        _next_call_at = start_at + 1.0 / SHEETS_RPS
+    if start_at > now:
+        time.sleep(start_at - now)
+
+def _record_sheets_outcome(failed):
+    """Update the circuit breaker after a Sheets call finished (or gave up)"""
+    global _breaker_failures, _breaker_open_until
+    with _breaker_lock:
+        if not failed:
+            _breaker_failures = 0
+            return
+        _breaker_failures += 1
+        if _breaker_failures >= _BREAKER_FAIL_MAX:
+            _breaker_open_until = time.monotonic() + _BREAKER_RESET
+            logger.error(f"Sheets API failing repeatedly - pausing calls for {_BREAKER_RESET}s")
+
+def sheets_execute(request, idempotent=True):
+    """
+    Execute a googleapiclient request under the concurrency/rate limits, retrying
+    429s, 5xxs and connection errors with exponential backoff (honouring
+    Retry-After when sent). Non-idempotent requests (appends) are only retried
+    on 429, which Google returns before applying the change. While the circuit
+    breaker is open, calls fail immediately.
+    """
+    if time.monotonic() < _breaker_open_until:
+        raise RuntimeError("Google Sheets is temporarily unavailable, please try again shortly")
     
-    return result
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        _wait_for_rate_slot()
+        try:
+            with _SHEETS_SEMAPHORE:
+                result = request.execute()
+            _record_sheets_outcome(failed=False)
+            return result
+        except HttpError as e:
+            status = e.resp.status
+            retryable = status == 429 or (idempotent and status in _RETRY_STATUSES)
+            if not retryable or attempt == SHEETS_MAX_RETRIES:
+                if status in _RETRY_STATUSES:
+                    _record_sheets_outcome(failed=True)
+                raise
+            retry_after = e.resp.get("retry-after")
+            if retry_after and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = min(8.0, 0.5 * 2 ** attempt) + random.uniform(0, 0.25)
+            logger.warning(f"Sheets API returned {status}, retrying in {delay:.2f}s (attempt {attempt + 1}/{SHEETS_MAX_RETRIES})")
+            time.sleep(delay)
+        except (OSError, httplib2.HttpLib2Error) as e:
+            # Timeouts, resets, DNS failures: an outage that never produces a status.
+            # A write may have reached Google before the connection dropped, so only
+            # idempotent requests are retried.
+            if not idempotent or attempt == SHEETS_MAX_RETRIES:
+                _record_sheets_outcome(failed=True)
+                raise
+            delay = min(8.0, 0.5 * 2 ** attempt) + random.uniform(0, 0.25)
+            logger.warning(f"Sheets API connection failed ({e!r}), retrying in {delay:.2f}s (attempt {attempt + 1}/{SHEETS_MAX_RETRIES})")
+            time.sleep(delay)
 
-def get_sheet_data(service, workbook_id, worksheet_name, conn_data=None):
-    """Helper function to get data from a specific worksheet"""
-    print(f"[DEBUG] Getting data from workbook {workbook_id}, worksheet {worksheet_name}")
+def get_sheet_ids(service, workbook_id, conn_data=None):
+    """
+    Resolve the numeric sheetIds (needed by spreadsheets().batchUpdate) of a
+    workbook's worksheets as {title: sheetId}. Read from the spreadsheet metadata
+    on every call: an id stored in connection.json can't be trusted on its own,
+    since a renamed or swapped tab would silently take the write. Ids that moved
+    are stored back into connection.json.
+    """
+    metadata = sheets_execute(service.spreadsheets().get(
+        spreadsheetId=workbook_id,
+        fields="sheets(properties(sheetId,title))"
+    ))
+    sheet_ids = {sheet["properties"]["title"]: sheet["properties"]["sheetId"] for sheet in metadata.get("sheets", [])}
+    if conn_data:
+        for section in ("inventory", "orders"):
+            config = conn_data.get(section, {})
+            if config.get("workbook_id") != workbook_id or config.get("worksheet_name") not in sheet_ids:
+                continue
+            if config.get("sheet_id_numeric") != sheet_ids[config["worksheet_name"]]:
+                logger.info("Sheet id of %s changed, storing the new one", config["worksheet_name"])
+                config["sheet_id_numeric"] = sheet_ids[config["worksheet_name"]]
+                config["sheet_id_title"] = config["worksheet_name"]
+                _persist_sheet_ids({(workbook_id, title): sheet_id for title, sheet_id in sheet_ids.items()})
+    return sheet_ids
+
+def _is_stale_sheet_id_error(error):
+    """True for the 400 batchUpdate returns when a sheetId no longer exists"""
+    return isinstance(error, HttpError) and error.resp.status == 400 and "No grid with id" in str(error)
+
+def a1_cell(worksheet_name, col_letter, row):
+    """A1 reference for a single cell, e.g. ('Orders', 'F', 12) -> 'Orders!F12'"""
+    return "%s!%s%d" % (worksheet_name, col_letter, row)
+
+def _write_inventory_qty(pending_writes, inventory_config, inventory_data, idx, new_stock):
+    """
+    Queue a stock write for inventory data row idx into pending_writes.
+    Returns False when the sheet has no quantity column to write to.
+    """
+    quantity_col = inventory_data["quantity_col_letter"]
+    if not quantity_col:
+        return False
+    range_name = a1_cell(inventory_config["worksheet_name"], quantity_col, idx + 2)
+    writes = pending_writes.setdefault(inventory_config["workbook_id"], [])
+    # A second write to the same stock cell (restore + deduct of one product)
+    # replaces the first, so each cell is sent once with its net value
+    for write in writes:
+        if write["range"] == range_name:
+            write["values"] = [[new_stock]]
+            return True
+    # Sent as a number so RAW stores a numeric cell, like the updateCells path does
+    writes.append({"range": range_name, "values": [[new_stock]]})
+    return True
+
+def flush_value_writes(service, pending_writes, value_input_option="RAW"):
+    """
+    Send queued cell writes with one values().batchUpdate per workbook.
+    pending_writes maps workbook_id -> [{"range": ..., "values": [[...]]}, ...].
+    """
+    def write(workbook_id, data):
+        sheets_execute(service.spreadsheets().values().batchUpdate(
+            spreadsheetId=workbook_id,
+            body={"valueInputOption": value_input_option, "data": data}
+        ))
+        logger.debug("Batch wrote %s cells to workbook %s", len(data), workbook_id)
     
-    # Check if we have stored table structure
-    table_structure = None
+    batches = [(workbook_id, data) for workbook_id, data in pending_writes.items() if data]
+    if len(batches) == 1:
+        write(*batches[0])
+    elif batches:
+        # Inventory and orders live in different workbooks - send both at once
+        futures = [_SHEETS_EXECUTOR.submit(write, workbook_id, data) for workbook_id, data in batches]
+        for future in futures:
+            future.result()
+
+def _idx_to_a1(col_index):
+    """0-based column index -> A1 column letters (0 -> A, 25 -> Z, 26 -> AA)"""
+    letters = ""
+    n = col_index + 1
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+# A..ZZ, which covers any realistic sheet; wider ones fall back to the encoder
+_COL_LETTERS = [_idx_to_a1(i) for i in range(702)]
+
+def column_letter(col_index):
+    """0-based column index -> A1 column letters"""
+    if col_index < 0:
+        # A negative index would otherwise wrap around to the end of the table
+        raise ValueError(f"Invalid column index: {col_index}")
+    if col_index < len(_COL_LETTERS):
+        return _COL_LETTERS[col_index]
+    return _idx_to_a1(col_index)
+
+# Header words that mark an inventory column as tracking stock (bound .search,
+# case-insensitive so headers need no lowercasing first)
+_HAS_QTY_HEADER = re.compile(r"quantity|stock|available", re.IGNORECASE).search
+_QTY_COL_HEADER = re.compile(r"quantity|qty|stock", re.IGNORECASE).search
+
+@functools.lru_cache(maxsize=64)
+def _sheet_schema(headers):
+    """
+    Schema facts that depend only on a sheet's header row, memoized per header tuple
+    so they are worked out once instead of on every order.
+    """
+    lowered = [str(header).lower() for header in headers]
+    # Orders-style cleaned header -> column letter, for writing back individual
+    # cells, and -> the header text as it appears in the sheet
+    header_col_letters = {}
+    header_names = {}
+    for col_idx, header in enumerate(lowered):
+        clean_header = header.replace(' ', '_').replace('(', '').replace(')', '').replace('-', '_')
+        if clean_header not in header_col_letters:
+            header_col_letters[clean_header] = column_letter(col_idx)
+            header_names[clean_header] = str(headers[col_idx])
+    has_quantity_column = any(_HAS_QTY_HEADER(h) for h in lowered)
+    quantity_col_index = None
+    quantity_col_letter = None
+    for col_idx, header in enumerate(lowered):
+        if _QTY_COL_HEADER(header):
+            quantity_col_index = col_idx
+            quantity_col_letter = column_letter(col_idx)
+            break
+    status_col_letter = next(
+        (column_letter(col_idx) for col_idx, header in enumerate(lowered) if "status" in header), None
+    )
+    return {
+        "has_quantity_column": has_quantity_column,
+        "quantity_col_index": quantity_col_index,
+        "quantity_col_letter": quantity_col_letter,
+        "header_col_letters": header_col_letters,
+        "header_names": header_names,
+        "status_col_letter": status_col_letter
+    }
+
+# Alias keys used when writing order updates -> the field they stand for
+_UPDATE_KEY_FIELDS = {
+    "product": "product", "product_name": "product", "item": "product", "item_name": "product",
+    "price": "price", "unit_price": "price",
+    "total": "total", "subtotal": "total",
+    "quantity": "quantity", "qty": "quantity",
+    "customer_name": "customer", "customer": "customer",
+    "customer_email": "email", "email": "email",
+    "customer_address": "address", "address": "address", "delivery_address": "address",
+    "payment_mode": "payment", "payment_type": "payment", "payment": "payment"
+}
+
+def _match_update_columns(update_data, header_col_letters):
+    """
+    Map update keys to the cleaned orders headers they write, {clean_header: value}.
+    Exact header matches claim their columns first, then the remaining keys take
+    the first free header containing (or contained in) the key. Aliases of one
+    field (customer / customer_name, ...) fill a single column.
+    """
+    pending = [(k, v) for k, v in update_data.items() if v]
+    matched = {}
+    fields_done = set()
+    for update_key, update_value in pending:
+        field = _UPDATE_KEY_FIELDS.get(update_key, update_key)
+        if update_key in header_col_letters and update_key not in matched and field not in fields_done:
+            matched[update_key] = update_value
+            fields_done.add(field)
+    for update_key, update_value in pending:
+        field = _UPDATE_KEY_FIELDS.get(update_key, update_key)
+        if field in fields_done:
+            continue
+        clean_header = next(
+            (h for h in header_col_letters
+             if h not in matched and (update_key in h or h in update_key)),
+            None
+        )
+        if clean_header is not None:
+            matched[clean_header] = update_value
+            fields_done.add(field)
+    return matched
+
+def _get_table_structure(worksheet_name, conn_data=None):
+    """Find the stored table structure for a worksheet (inventory or orders), if any"""
     if conn_data:
         # Find which sheet this is (inventory or orders)
         inventory_config = conn_data.get("inventory", {})
         orders_config = conn_data.get("orders", {})
         
         if inventory_config.get("worksheet_name") == worksheet_name:
-            table_structure = inventory_config.get("table_structure")
-            print(f"[DEBUG] Using stored inventory table structure")
+            logger.debug("Using stored inventory table structure")
+            return inventory_config.get("table_structure")
         elif orders_config.get("worksheet_name") == worksheet_name:
-            table_structure = orders_config.get("table_structure")
-            print(f"[DEBUG] Using stored orders table structure")
-    
-    if table_structure:
+            logger.debug("Using stored orders table structure")
+            return orders_config.get("table_structure")
+    return None
+
+def _sheet_range(worksheet_name, table_structure):
+    """
+    A1 range to read for a worksheet. Ranges are open-ended downwards (and, without
+    a stored structure, cover the whole sheet): Sheets trims trailing empty rows and
+    columns from the response, so nothing is gained by a fixed cut-off and rows
+    past it would silently be missed.
+    """
+    if table_structure and table_structure.get("headers"):
         # Use stored structure for precise data reading
         start_row = table_structure.get("start_row", 0) + 1  # Convert to 1-based
         start_col = table_structure.get("start_col", 0) + 1  # Convert to 1-based
         headers = table_structure.get("headers", [])
         
         # Calculate range based on stored structure
-        start_col_letter = chr(64 + start_col)  # Convert to column letter
-        end_col_letter = chr(64 + start_col + len(headers) - 1)
-        range_name = f"{worksheet_name}!{start_col_letter}{start_row + 1}:{end_col_letter}1000"  # Skip header row
-        
-        print(f"[DEBUG] Using stored structure range: {range_name}")
-        print(f"[DEBUG] Headers from structure: {headers}")
-        
-        res = service.spreadsheets().values().get(
-            spreadsheetId=workbook_id, 
-            range=range_name,
-            valueRenderOption='UNFORMATTED_VALUE'
-        ).execute()
+        start_col_letter = column_letter(start_col - 1)
+        end_col_letter = column_letter(start_col + len(headers) - 2)
+        range_name = f"{worksheet_name}!{start_col_letter}{start_row + 1}:{end_col_letter}"  # Skip header row
         
-        rows = res.get("values", [])
+        logger.debug("Using stored structure range: %s", range_name)
+        logger.debug("Headers from structure: %s", headers)
+        return range_name
+    
+    # Fallback to old method if no stored structure
+    logger.debug("No stored structure found, using fallback method")
+    
+    # Get ALL data from the specified worksheet
+    return worksheet_name
+
+def _rows_to_sheet_data(rows, table_structure):
+    """Convert raw values rows into the {'headers', 'data', 'row_count', ...} shape"""
+    if table_structure and table_structure.get("headers"):
+        headers = table_structure.get("headers", [])
         
         # Convert to list of dictionaries using stored headers
         sheet_data = []
         for row in rows:
-            # Skip completely empty rows
-            if not any(cell for cell in row if str(cell).strip()):
+            # Skip completely empty rows (Sheets returns "" for blank cells)
+            if not any(row):
                 continue
                 
             row_dict = {}
             for i, header in enumerate(headers):
                 # Get cell value or empty string if column doesn't exist in this row
-                cell_value = row[i] if i < len(row) else ""
-                row_dict[header] = str(cell_value).strip() if cell_value else ""
+                row_dict[header] = _cell_to_str(row[i]) if i < len(row) else ""
             
             sheet_data.append(row_dict)
-        
-        return {
-            'headers': headers,
-            'data': sheet_data,
-            'row_count': len(sheet_data)
-        }
     
     else:
-        # Fallback to old method if no stored structure
-        print(f"[DEBUG] No stored structure found, using fallback method")
-        
-        # Get ALL data from the specified worksheet (expanded range)
-        range_name = f"{worksheet_name}!A1:Z2000"  # Much larger range to catch all data
-        
-        res = service.spreadsheets().values().get(
-            spreadsheetId=workbook_id, 
-            range=range_name,
-            valueRenderOption='UNFORMATTED_VALUE'
-        ).execute()
-        
-        rows = res.get("values", [])
-        
         if not rows:
-            print("[DEBUG] No data found in fallback method")
-            return {"headers": [], "data": [], "row_count": 0}
+            logger.debug("No data found in fallback method")
+            return {"headers": [], "data": [], "row_count": 0, **_sheet_schema(())}
             
-        print(f"[DEBUG] Fallback method found {len(rows)} total rows")
+        logger.debug("Fallback method found %s total rows", len(rows))
         
         # Use first row as headers
         headers = rows[0] if rows else []
         data_rows = rows[1:] if len(rows) > 1 else []
         
-        print(f"[DEBUG] Headers: {headers}")
-        print(f"[DEBUG] Data rows to process: {len(data_rows)}")
+        logger.debug("Headers: %s", headers)
+        logger.debug("Data rows to process: %s", len(data_rows))
         
         # Convert to list of dictionaries using headers
         sheet_data = []
+        # Clean header names once (remove spaces, special chars for cleaner keys)
+        clean_headers = [str(header).strip().lower().replace(' ', '_').replace('-', '_') for header in headers]
+        # Checked once so the per-row debug logging costs nothing when it's disabled
+        debug = logger.isEnabledFor(logging.DEBUG)
+        
         for i, row in enumerate(data_rows):
-            # Skip completely empty rows
-            if not any(cell for cell in row if str(cell).strip()):
-                print(f"[DEBUG] Skipping empty row {i+2}")
+            # Skip completely empty rows (Sheets returns "" for blank cells)
+            if not any(row):
+                if debug:
+                    logger.debug("Skipping empty row %s", i+2)
                 continue
                 
             row_dict = {}
-            for j, header in enumerate(headers):
-                # Get cell value or empty string if column doesn't exist in this row
-                cell_value = row[j] if j < len(row) else ""
-                # Clean header name (remove spaces, special chars for cleaner keys)
-                clean_header = str(header).strip().lower().replace(' ', '_').replace('-', '_')
+            for j, clean_header in enumerate(clean_headers):
                 if clean_header:  # Only add if header is not empty
-                    row_dict[clean_header] = str(cell_value).strip() if cell_value else ""
+                    # Get cell value or empty string if column doesn't exist in this row
+                    row_dict[clean_header] = _cell_to_str(row[j]) if j < len(row) else ""
         
             if row_dict:  # Only add if row has some data
                 sheet_data.append(row_dict)
-                if len(sheet_data) <= 3:  # Debug first few rows
-                    print(f"[DEBUG] Row {i+2} data: {row_dict}")
+                if debug and len(sheet_data) <= 3:  # Debug first few rows
+                    logger.debug("Row %s data: %s", i+2, row_dict)
             
-        print(f"[DEBUG] Total processed rows: {len(sheet_data)}")
+        logger.debug("Total processed rows: %s", len(sheet_data))
     
     return {
         'headers': headers,
         'data': sheet_data,
-        'row_count': len(sheet_data)
+        'row_count': len(sheet_data),
+        **_sheet_schema(tuple(headers))
     }
 
-@mcp.tool()
-def process_customer_order_tool(customer_name: str, product_name: str, quantity: int, customer_email: str = "", notes: str = "", customer_address: str = "", payment_mode: str = "") -> str:
+def _cached_sheet_data(workbook_id, worksheet_name):
+    """Return cached sheet data if it hasn't expired yet, else None"""
+    with _SHEET_CACHE_LOCK:
+        entry = _SHEET_CACHE.get((workbook_id, worksheet_name))
+    if entry and time.monotonic() < entry[0]:
+        logger.debug("Sheet cache hit: %s", worksheet_name)
+        return entry[1]
+    return None
+
+def _sheet_cache_generation_now():
+    """Cache generation to pass to _store_sheet_data; take it before starting the read"""
+    with _SHEET_CACHE_LOCK:
+        return _sheet_cache_generation
+
+def _store_sheet_data(workbook_id, worksheet_name, sheet_data, generation):
+    """Cache sheet data read during `generation`, unless a write has invalidated it since"""
+    if SHEET_CACHE_TTL > 0:
+        with _SHEET_CACHE_LOCK:
+            if generation == _sheet_cache_generation:
+                _SHEET_CACHE[(workbook_id, worksheet_name)] = (time.monotonic() + SHEET_CACHE_TTL, sheet_data)
+
+def invalidate_sheet_cache(*sheet_configs):
+    """Drop cached data for the given inventory/orders configs after we write to them"""
+    global _sheet_cache_generation
+    with _SHEET_CACHE_LOCK:
+        _sheet_cache_generation += 1
+        for config in sheet_configs:
+            _SHEET_CACHE.pop((config["workbook_id"], config["worksheet_name"]), None)
+
+def _index_sheet_rows(sheet_data):
     """
-    Complete end-to-end order processing with dynamic schema analysis.
-    Automatically detects orders sheet columns and fills them with inventory data or provided customer data.
-    Returns detailed info about what customer information is still needed.
+    Detect each row's columns (_detect_columns) and build lookup indexes on the sheet
+    data, so tools can find an order by id or a product by name without rescanning
+    (and re-detecting) every row. Cached together with the sheet data.
     """
-    logger.info(f"Dynamic order processing: {customer_name} wants {quantity}x {product_name}")
+    rows = sheet_data["data"]
+    # Every row dict of a sheet is built from the same headers, so the column
+    # detection is done once for the sheet and only the values differ per row
+    columns = _detect_columns(tuple(rows[0]), "all") if rows else ()
+    detected = [
+        {col_type: {"key": key, "value": row[key], "clean_key": clean_key}
+         for col_type, key, clean_key in columns}
+        for row in rows
+    ]
+    by_id = {}
+    by_product_lower = {}
+    for idx, detected_cols in enumerate(detected):
+        if "id" in detected_cols:
+            by_id.setdefault(detected_cols["id"]["value"], idx)
+        if "product_name" in detected_cols:
+            by_product_lower.setdefault(detected_cols["product_name"]["value"].lower(), idx)
+    sheet_data["detected"] = detected
+    sheet_data["by_id"] = by_id
+    sheet_data["by_product_lower"] = by_product_lower
+    # Partial-name lookups resolved so far (including misses), see find_product_row
+    sheet_data["product_matches"] = {}
+    return sheet_data
+
+def find_product_row(sheet_data, product_name):
+    """
+    Row index of product_name in indexed inventory data: an exact (case-insensitive)
+    name match first, otherwise the first product whose name contains it. None if absent.
+    """
+    name = product_name.lower()
+    idx = sheet_data["by_product_lower"].get(name)
+    if idx is not None:
+        return idx
+    # The substring scan is O(rows); remember its answer for as long as this
+    # (cached) sheet data lives, so repeated queries for a partial name are O(1)
+    matches = sheet_data["product_matches"]
+    if name not in matches:
+        matches[name] = next((i for product_lower, i in sheet_data["by_product_lower"].items() if name in product_lower), None)
+    return matches[name]
+
+def get_sheet_data(service, workbook_id, worksheet_name, conn_data=None, fresh=False):
+    """
+    Helper function to get data from a specific worksheet.
+    fresh=True skips the cache (for reads that feed a write).
+    """
+    if not fresh:
+        cached = _cached_sheet_data(workbook_id, worksheet_name)
+        if cached is not None:
+            return cached
     
-    # Order deduplication - prevent duplicate orders from retries
-    import time
-    current_time = time.time()
-    order_key = f"{customer_name}_{product_name}_{quantity}_{customer_email}_{customer_address}"
+    logger.debug("Getting data from workbook %s, worksheet %s", workbook_id, worksheet_name)
+    generation = _sheet_cache_generation_now()
+    
+    table_structure = _get_table_structure(worksheet_name, conn_data)
+    res = sheets_execute(service.spreadsheets().values().get(
+        spreadsheetId=workbook_id, 
+        range=_sheet_range(worksheet_name, table_structure),
+        valueRenderOption='UNFORMATTED_VALUE'
+    ))
     
-    logger.debug(f"Order key: {order_key}")
+    sheet_data = _index_sheet_rows(_rows_to_sheet_data(res.get("values", []), table_structure))
+    _store_sheet_data(workbook_id, worksheet_name, sheet_data, generation)
+    return sheet_data
+
+def get_sheet_data_multi(service, workbook_id, worksheet_names, conn_data=None, fresh=False):
+    """Get data from several worksheets of one workbook with a single values().batchGet"""
+    results = {name: None if fresh else _cached_sheet_data(workbook_id, name) for name in worksheet_names}
+    missing = [name for name, data in results.items() if data is None]
     
-    # Check if we've processed this exact order in the last 30 seconds
-    if not hasattr(process_customer_order_tool, '_recent_orders'):
-        process_customer_order_tool._recent_orders = {}
-        logger.debug("Initialized recent orders cache")
+    if missing:
+        logger.debug("Batch getting data from workbook %s, worksheets %s", workbook_id, missing)
+        generation = _sheet_cache_generation_now()
+        
+        table_structures = [_get_table_structure(name, conn_data) for name in missing]
+        res = sheets_execute(service.spreadsheets().values().batchGet(
+            spreadsheetId=workbook_id,
+            ranges=[_sheet_range(name, ts) for name, ts in zip(missing, table_structures)],
+            valueRenderOption='UNFORMATTED_VALUE'
+        ))
+        
+        # valueRanges come back in the same order as the requested ranges
+        value_ranges = res.get("valueRanges", [])
+        for name, value_range, ts in zip(missing, value_ranges, table_structures):
+            results[name] = _index_sheet_rows(_rows_to_sheet_data(value_range.get("values", []), ts))
+            _store_sheet_data(workbook_id, name, results[name], generation)
     
-    # Clean old orders (older than 30 seconds)
-    old_count = len(process_customer_order_tool._recent_orders)
-    process_customer_order_tool._recent_orders = {
-        k: v for k, v in process_customer_order_tool._recent_orders.items() 
-        if current_time - v < 30
-    }
-    new_count = len(process_customer_order_tool._recent_orders)
-    if old_count != new_count:
-        logger.debug(f"Cleaned {old_count - new_count} old orders from cache")
+    return [results[name] for name in worksheet_names]
+
+def get_inventory_and_orders_data(service, conn_data, fresh=False):
+    """
+    Fetch the inventory and orders sheets in one round trip: a batchGet when they
+    share a workbook, otherwise two reads running concurrently.
+    Returns (inventory_data, orders_data).
+    """
+    inventory_config = conn_data["inventory"]
+    orders_config = conn_data["orders"]
     
-    logger.debug(f"Recent orders in cache: {list(process_customer_order_tool._recent_orders.keys())}")
+    if inventory_config["workbook_id"] == orders_config["workbook_id"]:
+        inventory_data, orders_data = get_sheet_data_multi(
+            service,
+            inventory_config["workbook_id"],
+            [inventory_config["worksheet_name"], orders_config["worksheet_name"]],
+            conn_data,
+            fresh
+        )
+        return inventory_data, orders_data
     
-    if order_key in process_customer_order_tool._recent_orders:
+    fut_inv = _SHEETS_EXECUTOR.submit(
+        get_sheet_data, service, inventory_config["workbook_id"], inventory_config["worksheet_name"], conn_data, fresh
+    )
+    fut_ord = _SHEETS_EXECUTOR.submit(
+        get_sheet_data, service, orders_config["workbook_id"], orders_config["worksheet_name"], conn_data, fresh
+    )
+    return fut_inv.result(), fut_ord.result()
+
+# Stock changes are read-modify-write against the inventory sheet. Tool calls run
+# on worker threads, so two orders/cancels for the same product could both read
+# the old stock and one write would be lost. Each product has its own lock, taken
+# once the fresh read shows which inventory rows a call touches, so calls for
+# different products (and updates that only change customer details) never wait
+# on each other. Releasing a product lock records a write sequence number; a call
+# that finds one newer than the start of its read lost the race and reads again.
+# (Only covers one server process, which is why the server refuses to start more
+# than one worker.)
+_STOCK_LOCKS = {}
+_STOCK_WRITES = {}
+_STOCK_LOCKS_GUARD = threading.Lock()
+_stock_seq = 0
+
+def _stock_key(inventory_data, product_name):
+    """Lock key for the inventory row product_name resolves to, or None if it has none"""
+    idx = find_product_row(inventory_data, product_name) if product_name else None
+    if idx is None:
+        return None
+    cell = inventory_data["detected"][idx].get("product_name", {}).get("value")
+    return str(cell or product_name).strip().lower()
+
+def _order_product(orders_data, order_id):
+    """Product name on an order's row ("" if the order isn't there)"""
+    order_idx = orders_data["by_id"].get(order_id)
+    if order_idx is None:
+        return ""
+    return orders_data["detected"][order_idx].get("product_name", {}).get("value", "")
+
+def _mark_stock_written(keys):
+    global _stock_seq
+    with _STOCK_LOCKS_GUARD:
+        _stock_seq += 1
+        for key in keys:
+            _STOCK_WRITES[key] = _stock_seq
+
+def _read_and_lock_stock(read, product_names_of):
+    """
+    Run read() -> (inventory_data, orders_data) and lock the stock of every product
+    product_names_of(data) names. Returns (data, locks); closing the ExitStack
+    releases the locks.
+    """
+    while True:
+        with _STOCK_LOCKS_GUARD:
+            started = _stock_seq
+        data = read()
+        keys = sorted({key for key in (_stock_key(data[0], name) for name in product_names_of(data)) if key})
+        with _STOCK_LOCKS_GUARD:
+            product_locks = [_STOCK_LOCKS.setdefault(key, threading.Lock()) for key in keys]
+        locks = contextlib.ExitStack()
+        # Sorted acquisition order, so an update touching two products can't deadlock
+        for lock in product_locks:
+            locks.enter_context(lock)
+        with _STOCK_LOCKS_GUARD:
+            stale = any(_STOCK_WRITES.get(key, 0) > started for key in keys)
+        if not stale:
+            locks.callback(_mark_stock_written, keys)
+            return data, locks
+        locks.close()
+
+def _is_duplicate_order(order_digest):
+    """True if the order was seen within _RECENT_TTL seconds; otherwise records it"""
+    # Expire entries older than 30 seconds; the dict is kept in insertion order
+    # so only the stale head needs to be inspected. Tools run on worker threads,
+    # so the check-and-record happens under a lock.
+    with _RECENT_LOCK:
+        now = time.monotonic()
+        expired = 0
+        while _recent_orders and now - next(iter(_recent_orders.values())) > _RECENT_TTL:
+            _recent_orders.popitem(last=False)
+            expired += 1
+        
+        duplicate = order_digest in _recent_orders
+        if not duplicate:
+            # Record this order, evicting the oldest entry once the cache is full
+            _recent_orders[order_digest] = now
+            if len(_recent_orders) > _RECENT_MAX:
+                _recent_orders.popitem(last=False)
+    if expired:
+        logger.debug("Cleaned %s old orders from cache", expired)
+    return duplicate
+
+def _process_customer_order(customer_name: str, product_name: str, quantity: int, customer_email: str = "", notes: str = "", customer_address: str = "", payment_mode: str = "") -> dict:
+    """Blocking implementation of process_customer_order_tool"""
+    logger.info(f"Dynamic order processing: {customer_name} wants {quantity}x {product_name}")
+    
+    # Order deduplication - prevent duplicate orders from retries
+    order_key = f"{customer_name}_{product_name}_{quantity}_{customer_email}_{customer_address}"
+    
+    logger.debug("Order key: %s", order_key)
+    # Store a fixed-size digest rather than the full customer/address string
+    order_digest = hashlib.blake2b(order_key.encode(), digest_size=16).digest()
+    
+    if _is_duplicate_order(order_digest):
         logger.warning(f"Duplicate order detected within 30 seconds - skipping: {order_key}")
-        return json.dumps({
+        return {
             "success": True, 
             "message": "Order already processed",
             "duplicate_prevention": True
-        })
+        }
     
-    # Record this order
     logger.info(f"Processing new order: {order_key}")
-    process_customer_order_tool._recent_orders[order_key] = current_time
     
+    result = _place_customer_order(customer_name, product_name, quantity, customer_email, notes, customer_address, payment_mode)
+    if result.get("error") in _ORDER_REJECTED_ERRORS:
+        # Rejected before anything was written, so a corrected retry must not be
+        # swallowed as a duplicate. Other failures (processing_failed) may have
+        # landed a write - keep the entry so an automatic retry can't book twice.
+        with _RECENT_LOCK:
+            _recent_orders.pop(order_digest, None)
+    return result
+
+def _place_customer_order(customer_name, product_name, quantity, customer_email, notes, customer_address, payment_mode):
+    """Validate the order, update inventory and record it (after the duplicate check)"""
     conn = load_connection()
     if not conn:
-        return json.dumps({"success": False, "error": "no_connection_configured"})
+        return {"success": False, "error": "no_connection_configured"}
     
     inventory_config = conn.get("inventory")
     orders_config = conn.get("orders")
     refresh_token = conn.get("refresh_token")
     
     if not all([inventory_config, orders_config, refresh_token]):
-        return json.dumps({"success": False, "error": "missing_configuration"})
+        return {"success": False, "error": "missing_configuration"}
     
+    stock_locks = contextlib.ExitStack()
     try:
         # Single Google Sheets service connection
-        service = build_sheets_service_from_refresh(refresh_token)
+        service = sheets_service_for(refresh_token)
         
-        # Step 1: Get inventory data
-        inventory_data = get_sheet_data(
-            service, 
-            inventory_config["workbook_id"], 
-            inventory_config["worksheet_name"],
-            conn
-        )
-        
-        # Step 2: Get orders sheet schema for dynamic column analysis
-        orders_data = get_sheet_data(
-            service,
-            orders_config["workbook_id"],
-            orders_config["worksheet_name"],
-            conn
+        # Step 1 & 2: Get inventory data and the orders sheet schema (for dynamic
+        # column analysis) - one batchGet when they share a workbook, else concurrently
+        (inventory_data, orders_data), stock_locks = _read_and_lock_stock(
+            lambda: get_inventory_and_orders_data(service, conn, fresh=True),
+            lambda data: (product_name,)
         )
         orders_headers = orders_data["headers"]
         
         # Step 3: Check if inventory has quantity tracking first
         inventory_headers = inventory_data["headers"]
-        has_quantity_column = any("quantity" in header.lower() or "stock" in header.lower() or "available" in header.lower() for header in inventory_headers)
-        print(f"[DEBUG] Inventory headers: {inventory_headers}")
-        print(f"[DEBUG] Has quantity tracking: {has_quantity_column}")
+        has_quantity_column = inventory_data["has_quantity_column"]
+        logger.debug("Inventory headers: %s", inventory_headers)
+        logger.debug("Has quantity tracking: %s", has_quantity_column)
         
         # Step 4: Find product and extract inventory details
         product_found = False
@@ -420,54 +1269,53 @@ def process_customer_order_tool(customer_name: str, product_name: str, quantity:
         product_details = {}
         product_detected_cols = {}
         
-        for idx, item in enumerate(inventory_data["data"]):
-            detected_cols = smart_column_detection(item, "all")
+        # Indexed lookup: exact name first, then the first row containing it
+        idx = find_product_row(inventory_data, product_name)
+        if idx is not None:
+            detected_cols = inventory_data["detected"][idx]
+            product_found = True
+            product_row_index = idx + 2
+            product_detected_cols = detected_cols  # Store for later use
             
-            if "product_name" in detected_cols:
-                product_value = detected_cols["product_name"]["value"]
-                if product_name.lower() in product_value.lower():
-                    product_found = True
-                    product_row_index = idx + 2
-                    product_detected_cols = detected_cols  # Store for later use
-                    
-                    # Extract all available product details
-                    for col_type, col_info in detected_cols.items():
-                        product_details[col_type] = str(col_info["value"]) if col_info["value"] else ""
-                    
-                    # Check quantity only if inventory has quantity tracking
-                    if has_quantity_column and "quantity" in detected_cols:
-                        try:
-                            available_quantity = int(float(detected_cols["quantity"]["value"])) if detected_cols["quantity"]["value"] else 0
-                        except:
-                            available_quantity = 0
-                    break
+            # Extract all available product details
+            for col_type, col_info in detected_cols.items():
+                product_details[col_type] = str(col_info["value"]) if col_info["value"] else ""
+            
+            # Check quantity only if inventory has quantity tracking
+            if has_quantity_column and "quantity" in detected_cols:
+                try:
+                    available_quantity = int(float(detected_cols["quantity"]["value"])) if detected_cols["quantity"]["value"] else 0
+                except (ValueError, TypeError, OverflowError):
+                    available_quantity = 0
         
         if not product_found:
-            return json.dumps({
+            return {
                 "success": False,
                 "error": "product_not_found",
                 "message": f"Product '{product_name}' not found in inventory"
-            })
+            }
+
+        # Parse the unit price once (remove currency symbols, etc.)
+        unit_price = parse_price(product_details.get("price", ""))
 
         # FIXED: For service/food businesses without stock tracking - make quantity check optional
         if has_quantity_column:
             has_quantity_tracking = "quantity" in product_detected_cols and product_detected_cols["quantity"]["value"]
-            print(f"[DEBUG] Product has quantity value: {has_quantity_tracking}, Available: {available_quantity}")
+            logger.debug("Product has quantity value: %s, Available: %s", has_quantity_tracking, available_quantity)
             
             if has_quantity_tracking and available_quantity < quantity:
-                return json.dumps({
+                return {
                     "success": False,
                     "error": "insufficient_stock",
                     "message": f"Only {available_quantity} units available, but {quantity} requested",
                     "available_quantity": available_quantity,
                     "requested_quantity": quantity
-                })
+                }
         else:
-            print(f"[DEBUG] No quantity tracking in inventory sheet - treating as service/food business")
+            logger.debug("No quantity tracking in inventory sheet - treating as service/food business")
             has_quantity_tracking = False
         
         # Step 4: Dynamic column mapping and customer data analysis
-        order_row_data = []
         missing_customer_info = []
         customer_provided_data = {
             "customer_name": customer_name,
@@ -480,121 +1328,40 @@ def process_customer_order_tool(customer_name: str, product_name: str, quantity:
             "order_id": f"ORD-{int(time.time())}"
         }
         
-        # Analyze each column in orders sheet
-        print(f"[DEBUG] Orders headers: {orders_headers}")
-        for header in orders_headers:
-            clean_header = header.lower().replace(' ', '_').replace('(', '').replace(')', '').replace('-', '_')
-            print(f"[DEBUG] Processing header: '{header}' -> clean: '{clean_header}'")
-            filled = False
-            value = ""
-            
-            # For customer-specific fields, try customer data first
-            customer_priority_fields = ["customer_name", "customer_email", "email", "customer_address", "address", "delivery", "payment_mode", "payment", "mode"]
-            
-            if any(field in clean_header for field in customer_priority_fields):
-                # Try customer data first for customer fields - FIXED: More specific matching
-                customer_mappings = {
-                    "customer_email": customer_provided_data["customer_email"],  # Check email first
-                    "email": customer_provided_data["customer_email"],
-                    "customer_name": customer_provided_data["customer_name"],
-                    "customer": customer_provided_data["customer_name"],  # This should come after email check
-                    "customer_address": customer_provided_data["customer_address"],
-                    "address": customer_provided_data["customer_address"],
-                    "delivery": customer_provided_data["customer_address"],
-                    "payment_mode": customer_provided_data["payment_mode"],
-                    "payment": customer_provided_data["payment_mode"],
-                    "mode": customer_provided_data["payment_mode"],
-                }
-                
-                for cust_key, cust_value in customer_mappings.items():
-                    if cust_key in clean_header:
-                        if cust_value:
-                            value = cust_value
-                            filled = True
-                            print(f"[DEBUG] Filled '{header}' from customer data: {cust_key} = {cust_value}")
-                        break
-            
-            # If not filled from customer data, try inventory data and calculations
-            if not filled:
-                # Calculate subtotal if we have price and quantity
-                subtotal_value = ""
-                if product_details.get("price"):
-                    try:
-                        # Extract numeric price (remove currency symbols, etc.)
-                        price_str = str(product_details.get("price", ""))
-                        price_numeric = ''.join(c for c in price_str if c.isdigit() or c == '.')
-                        if price_numeric:
-                            unit_price = float(price_numeric)
-                            subtotal_value = str(unit_price * quantity)
-                            print(f"[DEBUG] Calculated subtotal: {unit_price} × {quantity} = {subtotal_value}")
-                    except:
-                        print(f"[DEBUG] Could not calculate subtotal from price: {product_details.get('price')}")
-                
-                inventory_mappings = {
-                    "item_name": product_details.get("product_name", product_name),
-                    "product_name": product_details.get("product_name", product_name),
-                    "product": product_details.get("product_name", product_name),  # Added for "Product" column
-                    "item": product_details.get("product_name", product_name),  # Added for "Item" column
-                    "size": product_details.get("size", ""),
-                    "color": product_details.get("color", ""),
-                    "colour": product_details.get("color", ""),
-                    "price": product_details.get("price", ""),
-                    "price_pkr": product_details.get("price", ""),
-                    "unit_price": product_details.get("price", ""),
-                    "cost": product_details.get("price", ""),
-                    "subtotal": subtotal_value,  # Added for "Subtotal" column
-                    "total": subtotal_value,     # Alternative for total/subtotal columns
-                    "category": product_details.get("category", ""),
-                    "weight": product_details.get("weight", ""),
-                    "description": product_details.get("description", "")
-                }
-                
-                # Check if this column can be filled from inventory
-                print(f"[DEBUG] Looking for mappings for clean_header: '{clean_header}'")
-                print(f"[DEBUG] Product details: {product_details}")
-                print(f"[DEBUG] Available inventory mappings: {list(inventory_mappings.keys())}")
-                for inv_key, inv_value in inventory_mappings.items():
-                    print(f"[DEBUG] Checking {inv_key} -> {inv_value} (in '{clean_header}': {inv_key in clean_header})")
-                    if inv_key in clean_header and inv_value:
-                        value = inv_value
-                        filled = True
-                        print(f"[DEBUG] Filled '{header}' from inventory: {inv_key} = {inv_value}")
-                        break
-            
-            # If still not filled, try remaining customer data fields
-            if not filled:
-                remaining_customer_mappings = {
-                    "notes": customer_provided_data["notes"],
-                    "note": customer_provided_data["notes"],
-                    "quantity": customer_provided_data["quantity"],
-                    "qty": customer_provided_data["quantity"],
-                    "status": customer_provided_data["status"],
-                    "order_id": customer_provided_data["order_id"],
-                    "order_no": customer_provided_data["order_id"],
-                    "order": customer_provided_data["order_id"],
-                    "order_number": customer_provided_data["order_id"]
-                }
-                
-                for cust_key, cust_value in remaining_customer_mappings.items():
-                    if cust_key in clean_header:
-                        if cust_value:
-                            value = cust_value
-                            filled = True
-                            print(f"[DEBUG] Filled '{header}' from customer data: {cust_key} = {cust_value}")
-                        break
-            
-            # If still not filled, add empty value but note it's missing
-            if not filled:
-                print(f"[DEBUG] Could not map column '{header}' - adding as empty")
-            
-            order_row_data.append(value)
-            print(f"[DEBUG] Final value for '{header}': '{value}'")
+        # Calculate subtotal if we have price and quantity
+        subtotal_value = ""
+        if unit_price is not None:
+            subtotal_value = str(unit_price * quantity)
+            logger.debug("Calculated subtotal: %s × %s = %s", unit_price, quantity, subtotal_value)
+        elif product_details.get("price"):
+            logger.debug("Could not calculate subtotal from price: %s", product_details.get('price'))
+        
+        # Values for every field an orders header can map to, resolved once per order
+        field_values = dict(customer_provided_data)
+        field_values.update({
+            "product_name": product_details.get("product_name", product_name),
+            "size": product_details.get("size", ""),
+            "color": product_details.get("color", ""),
+            "price": product_details.get("price", ""),
+            "subtotal": subtotal_value,
+            "category": product_details.get("category", ""),
+            "weight": product_details.get("weight", ""),
+            "description": product_details.get("description", "")
+        })
+        
+        # Fill each orders column from the field its header maps to (memoized per
+        # schema); unmapped columns stay empty
+        logger.debug("Orders headers: %s", orders_headers)
+        order_row_data = [
+            field_values.get(field, "") if field else ""
+            for field in _orders_row_plan(tuple(orders_headers))
+        ]
         
-        print(f"[DEBUG] Complete order row data: {order_row_data}")
+        logger.debug("Complete order row data: %s", order_row_data)
         
         # Step 5: Check if we have all required customer information
         if missing_customer_info:
-            return json.dumps({
+            return {
                 "success": False,
                 "error": "missing_customer_information",
                 "message": "Additional customer information required to complete the order",
@@ -607,36 +1374,25 @@ def process_customer_order_tool(customer_name: str, product_name: str, quantity:
                     "available_quantity": available_quantity
                 },
                 "instructions": "Please provide the missing information and try the order again"
-            })
+            }
         
-        # Step 6: Update inventory (reduce stock) - FIXED: Only for businesses with quantity tracking
+        # Step 6: Work out the inventory cell to reduce - FIXED: Only for businesses with quantity tracking
         new_quantity = available_quantity
+        update_inventory = False
         if has_quantity_tracking:
             new_quantity = available_quantity - quantity
-            quantity_col = None
-            
-            for col_letter, header in enumerate(inventory_data["headers"], start=1):
-                if any(word in header.lower() for word in ["quantity", "qty", "stock"]):
-                    quantity_col = chr(64 + col_letter)
-                    break
+            quantity_col = inventory_data["quantity_col_letter"]
             
             if quantity_col and product_row_index > 0:
-                range_name = f"{inventory_config['worksheet_name']}!{quantity_col}{product_row_index}"
-                service.spreadsheets().values().update(
-                    spreadsheetId=inventory_config["workbook_id"],
-                    range=range_name,
-                    valueInputOption="RAW",
-                    body={"values": [[str(new_quantity)]]}
-                ).execute()
-                print(f"[DEBUG] Inventory updated: {available_quantity} -> {new_quantity}")
+                update_inventory = True
             else:
-                print(f"[DEBUG] Could not find quantity column for inventory update")
+                logger.debug("Could not find quantity column for inventory update")
         else:
-            print(f"[DEBUG] Skipping inventory update - service/food business without stock tracking")
+            logger.debug("Skipping inventory update - service/food business without stock tracking")
         
         # Step 7: Add order to orders sheet using stored table structure
-        print(f"[DEBUG] Adding order to sheet: {orders_config['worksheet_name']}")
-        print(f"[DEBUG] Order data: {order_row_data}")
+        logger.debug("Adding order to sheet: %s", orders_config['worksheet_name'])
+        logger.debug("Order data: %s", order_row_data)
         
         # Get stored table structure for proper positioning
         orders_table_structure = orders_config.get("table_structure", {})
@@ -644,58 +1400,119 @@ def process_customer_order_tool(customer_name: str, product_name: str, quantity:
         start_col = orders_table_structure.get("start_col", 0)  # 0-based from storage
         headers = orders_table_structure.get("headers", [])
         
-        # Calculate the correct range for appending
-        # Convert to 1-based for Google Sheets API
-        start_col_letter = chr(65 + start_col)  # Convert to column letter (A=0, B=1, etc.)
-        
-        # Handle empty headers case - use a safe default range
-        if len(headers) == 0:
-            print("[DEBUG] No headers found, using default range A:J")
-            append_range = f"{orders_config['worksheet_name']}!A:J"
+        # When both sheets live in one workbook, reduce stock and append the order
+        # in a single atomic spreadsheets().batchUpdate so a failure can't leave
+        # inventory decremented without the order row
+        inventory_sheet_id = orders_sheet_id = None
+        if inventory_config["workbook_id"] == orders_config["workbook_id"]:
+            sheet_ids = get_sheet_ids(service, orders_config["workbook_id"], conn)
+            inventory_sheet_id = sheet_ids.get(inventory_config["worksheet_name"])
+            orders_sheet_id = sheet_ids.get(orders_config["worksheet_name"])
+        
+        if inventory_sheet_id is not None and orders_sheet_id is not None:
+            def order_requests(inventory_sheet_id, orders_sheet_id):
+                requests = []
+                if update_inventory:
+                    # quantity_col_index counts from the table's first column
+                    inventory_start_col = inventory_config.get("table_structure", {}).get("start_col", 0)
+                    qty_col_idx = inventory_start_col + inventory_data["quantity_col_index"]
+                    requests.append({"updateCells": {
+                        "range": {
+                            "sheetId": inventory_sheet_id,
+                            "startRowIndex": product_row_index - 1,
+                            "endRowIndex": product_row_index,
+                            "startColumnIndex": qty_col_idx,
+                            "endColumnIndex": qty_col_idx + 1
+                        },
+                        "rows": [{"values": [{"userEnteredValue": {"numberValue": new_quantity}}]}],
+                        "fields": "userEnteredValue"
+                    }})
+                # appendCells always starts at column A, so pad up to the table's first column
+                order_cells = [{} for _ in range(start_col)]
+                order_cells += [{"userEnteredValue": {"stringValue": v}} if v else {} for v in order_row_data]
+                requests.append({"appendCells": {
+                    "sheetId": orders_sheet_id,
+                    "rows": [{"values": order_cells}],
+                    "fields": "userEnteredValue"
+                }})
+                return requests
+            
+            try:
+                sheets_execute(service.spreadsheets().batchUpdate(
+                    spreadsheetId=orders_config["workbook_id"],
+                    body={"requests": order_requests(inventory_sheet_id, orders_sheet_id)}
+                ), idempotent=False)
+            except HttpError as e:
+                if not _is_stale_sheet_id_error(e):
+                    raise
+                # A tab was deleted and recreated between the id lookup and the
+                # write. The rejected batch applied nothing, so look the ids up
+                # again and retry once.
+                logger.warning("Sheet id went stale, resolving it again: %s", e)
+                sheet_ids = get_sheet_ids(service, orders_config["workbook_id"], conn)
+                inventory_sheet_id = sheet_ids.get(inventory_config["worksheet_name"])
+                orders_sheet_id = sheet_ids.get(orders_config["worksheet_name"])
+                if inventory_sheet_id is None or orders_sheet_id is None:
+                    raise
+                sheets_execute(service.spreadsheets().batchUpdate(
+                    spreadsheetId=orders_config["workbook_id"],
+                    body={"requests": order_requests(inventory_sheet_id, orders_sheet_id)}
+                ), idempotent=False)
+            if update_inventory:
+                logger.debug("Inventory updated: %s -> %s", available_quantity, new_quantity)
+            logger.debug("Order appended successfully via batchUpdate")
         else:
-            end_col_letter = chr(65 + start_col + len(headers) - 1)
-            append_range = f"{orders_config['worksheet_name']}!{start_col_letter}:{end_col_letter}"
-        
-        print(f"[DEBUG] Using stored table structure:")
-        print(f"[DEBUG]   start_row: {start_row}, start_col: {start_col}")
-        print(f"[DEBUG]   Headers: {headers}")
-        print(f"[DEBUG]   Append range: {append_range}")
-        
-        append_result = service.spreadsheets().values().append(
-            spreadsheetId=orders_config["workbook_id"],
-            range=append_range,
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values": [order_row_data]}
-        ).execute()
-        
-        print(f"[DEBUG] Order appended successfully: {append_result}")
-        
-        # Create a beautiful order summary for the customer
-        total_price = float(product_details.get("price", 0)) * quantity
-        
-        order_summary = f"""✅ Order Confirmed!
-
-📋 Order Summary:
-• Order ID: {customer_provided_data["order_id"]}
-• Product: {product_details.get("product_name", product_name)}
-• Quantity: {quantity}
-• Price: PKR {product_details.get("price", "N/A")} each
-• Total: PKR {total_price:,.0f}
-
-👤 Customer Details:
-• Name: {customer_name}
-• Email: {customer_provided_data.get("customer_email", "Not provided")}
-• Address: {customer_provided_data.get("address", "Not provided")}
-• Payment: {customer_provided_data.get("payment_mode", "Not specified")}
-
-📦 Status: Processing now!
-Your order has been placed and inventory updated. Thank you for your purchase!"""
-
-        return json.dumps({
+            # Different workbooks: write the new stock level on the shared pool while
+            # the order row is appended, so the reply waits on one round trip, not two
+            inventory_write = None
+            if update_inventory:
+                range_name = a1_cell(inventory_config["worksheet_name"], quantity_col, product_row_index)
+                inventory_write = _SHEETS_EXECUTOR.submit(flush_value_writes, service, {
+                    inventory_config["workbook_id"]: [{"range": range_name, "values": [[new_quantity]]}]
+                })
+            
+            # Calculate the correct range for appending
+            # Convert to 1-based for Google Sheets API
+            start_col_letter = column_letter(start_col)
+            
+            # Without stored headers, give the whole sheet and let Sheets find the
+            # table (a fixed A:J range would misplace columns past J)
+            if len(headers) == 0:
+                logger.debug("No headers found, appending to the detected table")
+                append_range = orders_config['worksheet_name']
+            else:
+                end_col_letter = column_letter(start_col + len(headers) - 1)
+                append_range = f"{orders_config['worksheet_name']}!{start_col_letter}:{end_col_letter}"
+            
+            logger.debug("Using stored table structure:")
+            logger.debug("  start_row: %s, start_col: %s", start_row, start_col)
+            logger.debug("  Headers: %s", headers)
+            logger.debug("  Append range: %s", append_range)
+            
+            try:
+                append_result = sheets_execute(service.spreadsheets().values().append(
+                    spreadsheetId=orders_config["workbook_id"],
+                    range=append_range,
+                    valueInputOption="RAW",
+                    insertDataOption="INSERT_ROWS",
+                    includeValuesInResponse=False,
+                    body={"values": [order_row_data]}
+                ), idempotent=False)
+            finally:
+                # Always wait, so the inventory lock isn't released with the write still in flight
+                if inventory_write is not None:
+                    inventory_write.result()
+                    logger.debug("Inventory updated: %s -> %s", available_quantity, new_quantity)
+            
+            logger.debug("Order appended successfully: %s", append_result.get('updates', {}).get('updatedRange'))
+        
+        invalidate_sheet_cache(inventory_config, orders_config)
+        
+        total_price = (unit_price or 0) * quantity
+        
+        response = {
             "success": True,
             "message": "Order processed successfully",
-            "order_summary": order_summary,
             "order_details": {
                 "order_id": customer_provided_data["order_id"],
                 "customer_name": customer_name,
@@ -707,36 +1524,69 @@ Your order has been placed and inventory updated. Thank you for your purchase!""
                 "complete_order_data": dict(zip(orders_headers, order_row_data))
             },
             "timestamp": time.time()
-        })
+        }
+        
+        if INCLUDE_SUMMARY:
+            # Create a beautiful order summary for the customer
+            response["order_summary"] = "\n".join([
+                "✅ Order Confirmed!",
+                "",
+                "📋 Order Summary:",
+                f"• Order ID: {customer_provided_data['order_id']}",
+                f"• Product: {product_details.get('product_name', product_name)}",
+                f"• Quantity: {quantity}",
+                f"• Price: PKR {product_details.get('price', 'N/A')} each",
+                f"• Total: PKR {total_price:,.0f}",
+                "",
+                "👤 Customer Details:",
+                f"• Name: {customer_name}",
+                f"• Email: {customer_provided_data.get('customer_email', 'Not provided')}",
+                f"• Address: {customer_provided_data.get('address', 'Not provided')}",
+                f"• Payment: {customer_provided_data.get('payment_mode', 'Not specified')}",
+                "",
+                "📦 Status: Processing now!",
+                "Your order has been placed and inventory updated. Thank you for your purchase!"
+            ])
+        
+        return response
         
     except Exception as e:
         logger.error(f"Dynamic order processing failed: {e}")
-        return json.dumps({
+        # A write may have partly gone through - don't serve pre-write data
+        invalidate_sheet_cache(inventory_config, orders_config)
+        return {
             "success": False,
             "error": "processing_failed",
             "details": str(e)
-        })
+        }
+    finally:
+        stock_locks.close()
 
 @mcp.tool()
-def google_sheets_query_tool(query: str) -> str:
+async def process_customer_order_tool(customer_name: str, product_name: str, quantity: int, customer_email: str = "", notes: str = "", customer_address: str = "", payment_mode: str = "") -> dict:
     """
-    Main tool for answering product queries, checking availability, pricing, and product information.
-    Use this tool for all customer inquiries about products, stock, prices, and general inventory questions.
+    Complete end-to-end order processing with dynamic schema analysis.
+    Automatically detects orders sheet columns and fills them with inventory data or provided customer data.
+    Returns detailed info about what customer information is still needed.
     """
+    return await asyncio.to_thread(_process_customer_order, customer_name, product_name, quantity, customer_email, notes, customer_address, payment_mode)
+
+def _google_sheets_query(query: str) -> dict:
+    """Blocking implementation of google_sheets_query_tool"""
     logger.info(f"Product query from agent: {query}")
     
     conn = load_connection()
     if not conn:
-        return json.dumps({"error": "no_connection_configured"})
+        return {"error": "no_connection_configured"}
     
     inventory_config = conn.get("inventory")
     refresh_token = conn.get("refresh_token")
     
     if not inventory_config or not refresh_token:
-        return json.dumps({"error": "missing_inventory_config_or_token"})
+        return {"error": "missing_inventory_config_or_token"}
     
     try:
-        service = build_sheets_service_from_refresh(refresh_token)
+        service = sheets_service_for(refresh_token)
         inventory_data = get_sheet_data(
             service, 
             inventory_config["workbook_id"], 
@@ -744,87 +1594,87 @@ def google_sheets_query_tool(query: str) -> str:
             conn
         )
         
-        return json.dumps({
+        return {
             "query": query,
-            "inventory": inventory_data,
+            # Only the sheet contents - schema facts and lookup indexes are internal
+            "inventory": {key: inventory_data[key] for key in ("headers", "data", "row_count")},
             "timestamp": time.time(),
             "message": "Use this inventory data to answer the customer's query about products, availability, or pricing"
-        })
+        }
         
     except Exception as e:
-        print(f"[ERROR] Failed to query inventory: {e}")
-        return json.dumps({"error": str(e)})
+        logger.error("Failed to query inventory: %s", e)
+        return {"error": str(e)}
 
 @mcp.tool()
-def update_customer_order_tool(order_id: str, new_product_name: str = "", new_quantity: int = None, new_customer_name: str = "", new_customer_email: str = "", new_customer_address: str = "", new_payment_mode: str = "") -> str:
+async def google_sheets_query_tool(query: str) -> dict:
     """
-    Update an existing customer order by ORDER ID with intelligent inventory synchronization.
-    - Updates order details in orders sheet
-    - Handles PRODUCT CHANGES: Restores old product stock + deducts new product stock
-    - Handles QUANTITY CHANGES: Automatically adjusts inventory based on differences
-    - Supports updating customer information (name, email, address, payment mode)
-    - Intelligently maps new product details (price, category, etc.) when product changes
+    Main tool for answering product queries, checking availability, pricing, and product information.
+    Use this tool for all customer inquiries about products, stock, prices, and general inventory questions.
     """
+    return await asyncio.to_thread(_google_sheets_query, query)
+
+def _update_customer_order(order_id: str, new_product_name: str = "", new_quantity: int = None, new_customer_name: str = "", new_customer_email: str = "", new_customer_address: str = "", new_payment_mode: str = "") -> dict:
+    """Blocking implementation of update_customer_order_tool"""
     logger.info(f"Updating order: {order_id}")
     
+    # Nothing to change - don't read either sheet
+    if not any([new_product_name, new_quantity is not None, new_customer_name,
+                new_customer_email, new_customer_address, new_payment_mode]):
+        return {
+            "success": False,
+            "error": "no_fields_to_update",
+            "message": f"No new values were given for order {order_id}"
+        }
+    
     conn = load_connection()
     if not conn:
-        return json.dumps({"success": False, "error": "no_connection_configured"})
+        return {"success": False, "error": "no_connection_configured"}
     
-    headers = get_http_headers()
-    print(headers)
+    logger.debug("Request headers: %s", get_http_headers())
 
     inventory_config = conn.get("inventory")
     orders_config = conn.get("orders")
     refresh_token = conn.get("refresh_token")
     
     if not all([inventory_config, orders_config, refresh_token]):
-        return json.dumps({"success": False, "error": "missing_configuration"})
+        return {"success": False, "error": "missing_configuration"}
     
+    stock_locks = contextlib.ExitStack()
     try:
-        service = build_sheets_service_from_refresh(refresh_token)
-        
-        # Step 1: Get current orders data to find the order
-        orders_data = get_sheet_data(
-            service, 
-            orders_config["workbook_id"], 
-            orders_config["worksheet_name"],
-            conn
-        )
+        service = sheets_service_for(refresh_token)
+        
+        # Step 1: Get current orders data to find the order. Inventory is only
+        # needed when the product or quantity may change; then both sheets are
+        # read in a single round trip
+        if new_product_name or new_quantity is not None:
+            # Lock the stock of the order's current product and the new one
+            (inventory_data, orders_data), stock_locks = _read_and_lock_stock(
+                lambda: get_inventory_and_orders_data(service, conn, fresh=True),
+                lambda data: (_order_product(data[1], order_id), new_product_name)
+            )
+        else:
+            inventory_data = None
+            orders_data = get_sheet_data(service, orders_config["workbook_id"], orders_config["worksheet_name"], conn, fresh=True)
         
         # Step 2: Find the order to update
-        order_found = False
-        order_row_index = -1
-        current_order_data = {}
-        
-        for idx, order in enumerate(orders_data["data"]):
-            detected_cols = smart_column_detection(order, "all")
-            if "id" in detected_cols and detected_cols["id"]["value"] == order_id:
-                order_found = True
-                order_row_index = idx + 2  # +2 because sheets are 1-indexed and we skip header
-                current_order_data = detected_cols
-                break
-        
-        if not order_found:
-            return json.dumps({
+        order_idx = orders_data["by_id"].get(order_id)
+        
+        if order_idx is None:
+            return {
                 "success": False,
                 "error": "order_not_found",
                 "message": f"Order {order_id} not found"
-            })
+            }
+        
+        order_row_index = order_idx + 2  # +2 because sheets are 1-indexed and we skip header
+        current_order_data = orders_data["detected"][order_idx]
         
         # Step 3: Get current order details
         current_product_name = current_order_data.get("product_name", {}).get("value", "")
         current_quantity = int(current_order_data.get("quantity", {}).get("value", 0))
         
-        print(f"[DEBUG] Found order {order_id}: {current_product_name} x{current_quantity}")
-        
-        # Step 4: Get inventory data for product lookups
-        inventory_data = get_sheet_data(
-            service, 
-            inventory_config["workbook_id"], 
-            inventory_config["worksheet_name"],
-            conn
-        )
+        logger.debug("Found order %s: %s x%s", order_id, current_product_name, current_quantity)
         
         # Step 5: Handle PRODUCT CHANGE (most complex scenario)
         product_changed = new_product_name and new_product_name.lower() != current_product_name.lower()
@@ -832,171 +1682,125 @@ def update_customer_order_tool(order_id: str, new_product_name: str = "", new_qu
         final_quantity = new_quantity if new_quantity is not None else current_quantity
         
         new_product_details = {}
+        # Cell writes are queued per workbook and sent together once every check
+        # has passed, so an error part-way through leaves the sheets untouched
+        pending_writes = {}
         
         if product_changed:
-            print(f"[DEBUG] Product change detected: '{current_product_name}' -> '{new_product_name}'")
+            logger.debug("Product change detected: '%s' -> '%s'", current_product_name, new_product_name)
             
             # First: Restore original product inventory
-            if current_product_name:
-                for idx, item in enumerate(inventory_data["data"]):
-                    detected_cols = smart_column_detection(item, "all")
-                    if "product_name" in detected_cols:
-                        if current_product_name.lower() in detected_cols["product_name"]["value"].lower():
-                            # Safe integer conversion for original product inventory
-                            original_quantity_value = detected_cols.get("quantity", {}).get("value", "0")
-                            try:
-                                current_stock = int(original_quantity_value)
-                                has_original_numeric_inventory = True
-                            except (ValueError, TypeError):
-                                # Non-numeric inventory - skip restoration for service business
-                                has_original_numeric_inventory = False
-                                print(f"[DEBUG] Non-numeric original inventory: '{original_quantity_value}' - skipping restoration")
-                            
-                            if has_original_numeric_inventory:
-                                restored_stock = current_stock + current_quantity
-                                
-                                # Update inventory for old product
-                                product_row_index = idx + 2
-                                quantity_col = None
-                                for col_letter, header in enumerate(inventory_data["headers"], start=1):
-                                    if any(word in header.lower() for word in ["quantity", "qty", "stock"]):
-                                        quantity_col = chr(64 + col_letter)
-                                        break
-                                
-                                if quantity_col and product_row_index > 0:
-                                    range_name = f"{inventory_config['worksheet_name']}!{quantity_col}{product_row_index}"
-                                    service.spreadsheets().values().update(
-                                        spreadsheetId=inventory_config["workbook_id"],
-                                        range=range_name,
-                                        valueInputOption="RAW",
-                                        body={"values": [[str(restored_stock)]]}
-                                    ).execute()
-                                    print(f"[DEBUG] Restored old product inventory: {current_product_name} {current_stock} -> {restored_stock}")
-                            else:
-                                print(f"[DEBUG] Skipping original inventory restoration for service business: {current_product_name}")
-                            break
+            restored_idx = restored_stock = None
+            idx = find_product_row(inventory_data, current_product_name) if current_product_name else None
+            if idx is not None:
+                detected_cols = inventory_data["detected"][idx]
+                # Safe integer conversion for original product inventory
+                original_quantity_value = detected_cols.get("quantity", {}).get("value", "0")
+                try:
+                    current_stock = int(original_quantity_value)
+                    has_original_numeric_inventory = True
+                except (ValueError, TypeError):
+                    # Non-numeric inventory - skip restoration for service business
+                    has_original_numeric_inventory = False
+                    logger.debug("Non-numeric original inventory: '%s' - skipping restoration", original_quantity_value)
+                
+                if has_original_numeric_inventory:
+                    restored_stock = current_stock + current_quantity
+                    restored_idx = idx
+                    
+                    if _write_inventory_qty(pending_writes, inventory_config, inventory_data, idx, restored_stock):
+                        logger.debug("Restoring old product inventory: %s %s -> %s", current_product_name, current_stock, restored_stock)
+                else:
+                    logger.debug("Skipping original inventory restoration for service business: %s", current_product_name)
             
             # Second: Find new product and get its details
-            new_product_found = False
-            for idx, item in enumerate(inventory_data["data"]):
-                detected_cols = smart_column_detection(item, "all")
-                if "product_name" in detected_cols:
-                    if new_product_name.lower() in detected_cols["product_name"]["value"].lower():
-                        new_product_found = True
-                        new_product_details = {
-                            "product_name": detected_cols["product_name"]["value"],
-                            "price": detected_cols.get("price", {}).get("value", ""),
-                            "category": detected_cols.get("category", {}).get("value", ""),
-                            "size": detected_cols.get("size", {}).get("value", ""),
-                            "color": detected_cols.get("color", {}).get("value", ""),
-                            "weight": detected_cols.get("weight", {}).get("value", ""),  # Added weight
-                            "description": detected_cols.get("description", {}).get("value", "")
-                        }
-                        
-                        # Check availability for new product - handle non-numeric quantities (like "Daily")
-                        quantity_value = detected_cols.get("quantity", {}).get("value", "0")
-                        try:
-                            available_stock = int(quantity_value)
-                            has_numeric_inventory = True
-                        except (ValueError, TypeError):
-                            # Non-numeric inventory (like "Daily", "Available", "Limited") - skip inventory checks
-                            available_stock = 999999  # Treat as unlimited for food/service businesses
-                            has_numeric_inventory = False
-                            print(f"[DEBUG] Non-numeric inventory detected: '{quantity_value}' - treating as service business")
-                        
-                        if has_numeric_inventory and available_stock < final_quantity:
-                            return json.dumps({
-                                "success": False,
-                                "error": "insufficient_stock",
-                                "message": f"New product '{new_product_name}' has only {available_stock} units available, but {final_quantity} requested."
-                            })
-                        
-                        # Only update inventory for businesses with numeric stock tracking
-                        if has_numeric_inventory:
-                            # Deduct inventory for new product
-                            new_stock = available_stock - final_quantity
-                            product_row_index = idx + 2
-                            quantity_col = None
-                            for col_letter, header in enumerate(inventory_data["headers"], start=1):
-                                if any(word in header.lower() for word in ["quantity", "qty", "stock"]):
-                                    quantity_col = chr(64 + col_letter)
-                                    break
-                            
-                            if quantity_col and product_row_index > 0:
-                                range_name = f"{inventory_config['worksheet_name']}!{quantity_col}{product_row_index}"
-                                service.spreadsheets().values().update(
-                                    spreadsheetId=inventory_config["workbook_id"],
-                                    range=range_name,
-                                    valueInputOption="RAW",
-                                    body={"values": [[str(new_stock)]]}
-                                ).execute()
-                                print(f"[DEBUG] Updated new product inventory: {new_product_name} {available_stock} -> {new_stock}")
-                        else:
-                            print(f"[DEBUG] Skipping inventory update for service business: {new_product_name}")
-                        break
-            
-            if not new_product_found:
-                return json.dumps({
+            idx = find_product_row(inventory_data, new_product_name)
+            if idx is None:
+                return {
                     "success": False,
                     "error": "new_product_not_found",
                     "message": f"New product '{new_product_name}' not found in inventory"
-                })
+                }
+            
+            detected_cols = inventory_data["detected"][idx]
+            new_product_details = {
+                "product_name": detected_cols["product_name"]["value"],
+                "price": detected_cols.get("price", {}).get("value", ""),
+                "category": detected_cols.get("category", {}).get("value", ""),
+                "size": detected_cols.get("size", {}).get("value", ""),
+                "color": detected_cols.get("color", {}).get("value", ""),
+                "weight": detected_cols.get("weight", {}).get("value", ""),  # Added weight
+                "description": detected_cols.get("description", {}).get("value", "")
+            }
+            
+            # Check availability for new product - handle non-numeric quantities (like "Daily")
+            quantity_value = detected_cols.get("quantity", {}).get("value", "0")
+            try:
+                available_stock = int(quantity_value)
+                has_numeric_inventory = True
+                if idx == restored_idx:
+                    # The "new" name resolved to the same inventory row (e.g. a partial
+                    # name) - deduct from the restored stock, not the stale sheet value
+                    available_stock = restored_stock
+            except (ValueError, TypeError):
+                # Non-numeric inventory (like "Daily", "Available", "Limited") - skip inventory checks
+                available_stock = 999999  # Treat as unlimited for food/service businesses
+                has_numeric_inventory = False
+                logger.debug("Non-numeric inventory detected: '%s' - treating as service business", quantity_value)
+            
+            if has_numeric_inventory and available_stock < final_quantity:
+                return {
+                    "success": False,
+                    "error": "insufficient_stock",
+                    "message": f"New product '{new_product_name}' has only {available_stock} units available, but {final_quantity} requested."
+                }
+            
+            # Only update inventory for businesses with numeric stock tracking
+            if has_numeric_inventory:
+                # Deduct inventory for new product
+                new_stock = available_stock - final_quantity
+                if _write_inventory_qty(pending_writes, inventory_config, inventory_data, idx, new_stock):
+                    logger.debug("Updating new product inventory: %s %s -> %s", new_product_name, available_stock, new_stock)
+            else:
+                logger.debug("Skipping inventory update for service business: %s", new_product_name)
         
         elif quantity_changed:
             # Step 6: Handle QUANTITY CHANGE ONLY (original logic)
-            print(f"[DEBUG] Quantity change detected: {current_quantity} -> {new_quantity}")
+            logger.debug("Quantity change detected: %s -> %s", current_quantity, new_quantity)
             
             # Find current product in inventory
-            for idx, item in enumerate(inventory_data["data"]):
-                detected_cols = smart_column_detection(item, "all")
-                if "product_name" in detected_cols:
-                    if current_product_name.lower() in detected_cols["product_name"]["value"].lower():
-                        # Safe integer conversion for quantity-only changes
-                        quantity_value = detected_cols.get("quantity", {}).get("value", "0")
-                        try:
-                            current_stock = int(quantity_value)
-                            has_numeric_stock = True
-                        except (ValueError, TypeError):
-                            # Non-numeric inventory - skip quantity changes for service business
-                            has_numeric_stock = False
-                            print(f"[DEBUG] Non-numeric inventory: '{quantity_value}' - skipping quantity adjustment for service business")
-                        
-                        if has_numeric_stock:
-                            quantity_difference = new_quantity - current_quantity
-                            new_stock = current_stock - quantity_difference
-                            
-                            print(f"[DEBUG] Inventory adjustment: {current_quantity} -> {new_quantity} (diff: {quantity_difference})")
-                            print(f"[DEBUG] Stock adjustment: {current_stock} -> {new_stock}")
-                            
-                            # Check if we have enough stock for increase
-                            if quantity_difference > 0 and current_stock < quantity_difference:
-                                return json.dumps({
-                                    "success": False,
-                                    "error": "insufficient_stock",
-                                    "message": f"Cannot increase quantity by {quantity_difference}. Only {current_stock} units available."
-                                })
-                            
-                            # Update inventory
-                            product_row_index = idx + 2
-                            quantity_col = None
-                            for col_letter, header in enumerate(inventory_data["headers"], start=1):
-                                if any(word in header.lower() for word in ["quantity", "qty", "stock"]):
-                                    quantity_col = chr(64 + col_letter)
-                                    break
-                            
-                            if quantity_col and product_row_index > 0:
-                                range_name = f"{inventory_config['worksheet_name']}!{quantity_col}{product_row_index}"
-                                service.spreadsheets().values().update(
-                                    spreadsheetId=inventory_config["workbook_id"],
-                                    range=range_name,
-                                    valueInputOption="RAW",
-                                    body={"values": [[str(new_stock)]]}
-                                ).execute()
-                                print(f"[DEBUG] Inventory updated: {current_stock} -> {new_stock}")
-                        else:
-                            print(f"[DEBUG] Skipping quantity adjustment for service business")
-                        break
-                        break
+            idx = find_product_row(inventory_data, current_product_name)
+            if idx is not None:
+                detected_cols = inventory_data["detected"][idx]
+                # Safe integer conversion for quantity-only changes
+                quantity_value = detected_cols.get("quantity", {}).get("value", "0")
+                try:
+                    current_stock = int(quantity_value)
+                    has_numeric_stock = True
+                except (ValueError, TypeError):
+                    # Non-numeric inventory - skip quantity changes for service business
+                    has_numeric_stock = False
+                    logger.debug("Non-numeric inventory: '%s' - skipping quantity adjustment for service business", quantity_value)
+                
+                if has_numeric_stock:
+                    quantity_difference = new_quantity - current_quantity
+                    new_stock = current_stock - quantity_difference
+                    
+                    logger.debug("Inventory adjustment: %s -> %s (diff: %s)", current_quantity, new_quantity, quantity_difference)
+                    logger.debug("Stock adjustment: %s -> %s", current_stock, new_stock)
+                    
+                    # Check if we have enough stock for increase
+                    if quantity_difference > 0 and current_stock < quantity_difference:
+                        return {
+                            "success": False,
+                            "error": "insufficient_stock",
+                            "message": f"Cannot increase quantity by {quantity_difference}. Only {current_stock} units available."
+                        }
+                    
+                    if _write_inventory_qty(pending_writes, inventory_config, inventory_data, idx, new_stock):
+                        logger.debug("Inventory update queued: %s -> %s", current_stock, new_stock)
+                else:
+                    logger.debug("Skipping quantity adjustment for service business")
         
         # Step 7: Update order details in orders sheet
         update_data = {}
@@ -1004,16 +1808,11 @@ def update_customer_order_tool(order_id: str, new_product_name: str = "", new_qu
         # Prepare update values based on what's provided
         if product_changed and new_product_details:
             # Calculate new total if product changed
-            try:
-                price_str = str(new_product_details.get("price", ""))
-                price_numeric = ''.join(c for c in price_str if c.isdigit() or c == '.')
-                if price_numeric:
-                    unit_price = float(price_numeric)
-                    new_total = str(unit_price * final_quantity)
-                    print(f"[DEBUG] Calculated new total: {unit_price} × {final_quantity} = {new_total}")
-                else:
-                    new_total = ""
-            except:
+            unit_price = parse_price(new_product_details.get("price", ""))
+            if unit_price is not None:
+                new_total = str(unit_price * final_quantity)
+                logger.debug("Calculated new total: %s × %s = %s", unit_price, final_quantity, new_total)
+            else:
                 new_total = ""
                 
             update_data.update({
@@ -1051,271 +1850,270 @@ def update_customer_order_tool(order_id: str, new_product_name: str = "", new_qu
             update_data["payment"] = new_payment_mode
         
         # Update each column that has new data
-        orders_headers = orders_data["headers"]
         updates_applied = []
         
-        for col_idx, header in enumerate(orders_headers):
-            clean_header = header.lower().replace(' ', '_').replace('(', '').replace(')', '').replace('-', '_')
-            
-            # Find matching update data
-            for update_key, update_value in update_data.items():
-                if update_value and (update_key in clean_header or clean_header in update_key):
-                    col_letter = chr(65 + col_idx)  # A=0, B=1, etc.
-                    range_name = f"{orders_config['worksheet_name']}!{col_letter}{order_row_index}"
-                    
-                    service.spreadsheets().values().update(
-                        spreadsheetId=orders_config["workbook_id"],
-                        range=range_name,
-                        valueInputOption="RAW",
-                        body={"values": [[update_value]]}
-                    ).execute()
-                    print(f"[DEBUG] Updated {header}: {update_value}")
-                    updates_applied.append(f"{header}: {update_value}")
-                    break
+        header_col_letters = orders_data["header_col_letters"]
+        matched = _match_update_columns(update_data, header_col_letters)
+        
+        # Cells that already hold the new value (e.g. a retried update) are not rewritten
+        current_row = {
+            str(key).lower().replace(' ', '_').replace('(', '').replace(')', '').replace('-', '_'): value
+            for key, value in orders_data["data"][order_idx].items()
+        }
+        
+        for clean_header, update_value in matched.items():
+            if current_row.get(clean_header) == str(update_value):
+                logger.debug("Skipping %s: already %s", clean_header, update_value)
+                continue
+            range_name = a1_cell(orders_config["worksheet_name"], header_col_letters[clean_header], order_row_index)
+            pending_writes.setdefault(orders_config["workbook_id"], []).append(
+                {"range": range_name, "values": [[update_value]]}
+            )
+            logger.debug("Updating %s: %s", clean_header, update_value)
+            updates_applied.append(f"{orders_data['header_names'][clean_header]}: {update_value}")
+        
+        flush_value_writes(service, pending_writes)
+        invalidate_sheet_cache(inventory_config, orders_config)
         
         # Step 8: Return success response
         final_product_name = new_product_details.get("product_name", current_product_name) if product_changed else current_product_name
         
-        return json.dumps({
+        response = {
             "success": True,
             "message": f"Order {order_id} updated successfully",
             "order_id": order_id,
             "updates_applied": updates_applied,
             "product_changed": product_changed,
-            "inventory_adjusted": product_changed or quantity_changed,
-            "order_summary": f"""
-📋 ORDER UPDATED SUCCESSFULLY!
-
-🆔 Order ID: {order_id}
-📦 Product: {f'{current_product_name} → {final_product_name}' if product_changed else final_product_name}
-🔢 Quantity: {f'{current_quantity} → {final_quantity}' if quantity_changed else final_quantity}
-👤 Customer: {new_customer_name if new_customer_name else 'unchanged'}
-📧 Email: {new_customer_email if new_customer_email else 'unchanged'}
-💳 Payment: {new_payment_mode if new_payment_mode else 'unchanged'}
-📍 Address: {new_customer_address if new_customer_address else 'unchanged'}
-
-✅ Your order has been updated and inventory synchronized!
-{f'💰 New Price: {new_product_details.get("price", "")} PKR' if product_changed else ''}"""
-        })
+            "inventory_adjusted": product_changed or quantity_changed
+        }
+        
+        if INCLUDE_SUMMARY:
+            response["order_summary"] = "\n".join([
+                "",
+                "📋 ORDER UPDATED SUCCESSFULLY!",
+                "",
+                f"🆔 Order ID: {order_id}",
+                f"📦 Product: {f'{current_product_name} → {final_product_name}' if product_changed else final_product_name}",
+                f"🔢 Quantity: {f'{current_quantity} → {final_quantity}' if quantity_changed else final_quantity}",
+                f"👤 Customer: {new_customer_name or 'unchanged'}",
+                f"📧 Email: {new_customer_email or 'unchanged'}",
+                f"💳 Payment: {new_payment_mode or 'unchanged'}",
+                f"📍 Address: {new_customer_address or 'unchanged'}",
+                "",
+                "✅ Your order has been updated and inventory synchronized!",
+                f"💰 New Price: {new_product_details.get('price', '')} PKR" if product_changed else ""
+            ])
+        
+        return response
         
     except Exception as e:
         logger.error(f"Order update failed: {e}")
-        return json.dumps({
+        # A write may have partly gone through - don't serve pre-write data
+        invalidate_sheet_cache(inventory_config, orders_config)
+        return {
             "success": False,
             "error": "update_failed",
             "details": str(e)
-        })
+        }
+    finally:
+        stock_locks.close()
 
 @mcp.tool()
-def cancel_customer_order_tool(order_id: str) -> str:
+async def update_customer_order_tool(order_id: str, new_product_name: str = "", new_quantity: int = None, new_customer_name: str = "", new_customer_email: str = "", new_customer_address: str = "", new_payment_mode: str = "") -> dict:
     """
-    Cancel an existing customer order by ORDER ID and restore inventory.
-    - Marks order status as 'Cancelled' instead of deleting the row
-    - Restores full quantity back to inventory
-    - Preserves order history for business records and analytics
+    Update an existing customer order by ORDER ID with intelligent inventory synchronization.
+    - Updates order details in orders sheet
+    - Handles PRODUCT CHANGES: Restores old product stock + deducts new product stock
+    - Handles QUANTITY CHANGES: Automatically adjusts inventory based on differences
+    - Supports updating customer information (name, email, address, payment mode)
+    - Intelligently maps new product details (price, category, etc.) when product changes
     """
+    return await asyncio.to_thread(_update_customer_order, order_id, new_product_name, new_quantity, new_customer_name, new_customer_email, new_customer_address, new_payment_mode)
+
+def _cancel_customer_order(order_id: str) -> dict:
+    """Blocking implementation of cancel_customer_order_tool"""
     logger.info(f"Cancelling order: {order_id}")
     
     conn = load_connection()
     if not conn:
-        return json.dumps({"success": False, "error": "no_connection_configured"})
+        return {"success": False, "error": "no_connection_configured"}
     
     inventory_config = conn.get("inventory")
     orders_config = conn.get("orders")
     refresh_token = conn.get("refresh_token")
     
     if not all([inventory_config, orders_config, refresh_token]):
-        return json.dumps({"success": False, "error": "missing_configuration"})
+        return {"success": False, "error": "missing_configuration"}
     
+    stock_locks = contextlib.ExitStack()
     try:
-        service = build_sheets_service_from_refresh(refresh_token)
+        service = sheets_service_for(refresh_token)
         
-        # Step 1: Get current orders data to find the order
-        orders_data = get_sheet_data(
-            service, 
-            orders_config["workbook_id"], 
-            orders_config["worksheet_name"],
-            conn
+        # Step 1: Get current orders data to find the order, plus inventory for
+        # product lookups, in a single round trip; lock the order's product stock
+        (inventory_data, orders_data), stock_locks = _read_and_lock_stock(
+            lambda: get_inventory_and_orders_data(service, conn, fresh=True),
+            lambda data: (_order_product(data[1], order_id),)
         )
         
         # Step 2: Find the order to cancel
-        order_found = False
-        order_row_index = -1
-        order_details = {}
-        
-        for idx, order in enumerate(orders_data["data"]):
-            detected_cols = smart_column_detection(order, "all")
-            if "id" in detected_cols and detected_cols["id"]["value"] == order_id:
-                order_found = True
-                order_row_index = idx + 2  # +2 because sheets are 1-indexed and we skip header
-                order_details = {
-                    "product_name": detected_cols.get("product_name", {}).get("value", ""),
-                    "quantity": int(detected_cols.get("quantity", {}).get("value", 0)),
-                    "customer_name": detected_cols.get("customer_name", {}).get("value", ""),
-                    "total": detected_cols.get("price", {}).get("value", "")
-                }
-                break
+        order_idx = orders_data["by_id"].get(order_id)
         
-        if not order_found:
-            return json.dumps({
+        if order_idx is None:
+            return {
                 "success": False, 
                 "error": "order_not_found",
                 "message": f"Order {order_id} not found"
-            })
+            }
+        
+        order_row_index = order_idx + 2  # +2 because sheets are 1-indexed and we skip header
+        detected_cols = orders_data["detected"][order_idx]
+        order_details = {
+            "product_name": detected_cols.get("product_name", {}).get("value", ""),
+            "quantity": int(detected_cols.get("quantity", {}).get("value", 0)),
+            "customer_name": detected_cols.get("customer_name", {}).get("value", ""),
+            "total": detected_cols.get("price", {}).get("value", "")
+        }
         
-        print(f"[DEBUG] Found order to cancel: {order_details}")
+        logger.debug("Found order to cancel: %s", order_details)
         
         # Step 3: Check current order status before cancelling
-        current_status = ""
-        for idx, order in enumerate(orders_data["data"]):
-            if idx + 2 == order_row_index:
-                detected_cols = smart_column_detection(order, "all")
-                current_status = detected_cols.get("status", {}).get("value", "").strip()
-                print(f"[DEBUG] Current order status: '{current_status}'")
-                break
+        current_status = detected_cols.get("status", {}).get("value", "").strip()
+        logger.debug("Current order status: '%s'", current_status)
         
         # Only allow cancelling Pending orders
         if current_status.lower() == "cancelled":
-            return json.dumps({
+            return {
                 "success": False,
                 "error": "already_cancelled", 
                 "message": f"Order {order_id} is already cancelled"
-            })
+            }
         elif current_status.lower() == "delivered":
-            return json.dumps({
+            return {
                 "success": False,
                 "error": "cannot_cancel_delivered", 
                 "message": f"Order {order_id} has already been delivered and cannot be cancelled"
-            })
+            }
         elif current_status and current_status.lower() not in ["pending", ""]:
-            return json.dumps({
+            return {
                 "success": False,
                 "error": "invalid_status_for_cancellation", 
                 "message": f"Order {order_id} has status '{current_status}' and cannot be cancelled"
-            })
+            }
         
         # Step 4: Restore inventory - add back the quantity that was deducted
         product_name = order_details["product_name"]
         quantity_to_restore = order_details["quantity"]
+        pending_writes = {}
         
         if product_name and quantity_to_restore > 0:
-            # Get inventory data
-            inventory_data = get_sheet_data(
-                service, 
-                inventory_config["workbook_id"], 
-                inventory_config["worksheet_name"],
-                conn
-            )
-            
             # Find the product in inventory
             product_found = False
-            product_row_index = -1
             current_stock = 0
+            has_cancel_numeric_inventory = False
             
-            for idx, item in enumerate(inventory_data["data"]):
-                detected_cols = smart_column_detection(item, "all")
-                if "product_name" in detected_cols:
-                    if product_name.lower() in detected_cols["product_name"]["value"].lower():
-                        product_found = True
-                        product_row_index = idx + 2
-                        if "quantity" in detected_cols:
-                            # Safe integer conversion for cancellation restoration
-                            cancel_quantity_value = detected_cols["quantity"]["value"] or "0"
-                            try:
-                                current_stock = int(cancel_quantity_value)
-                                has_cancel_numeric_inventory = True
-                            except (ValueError, TypeError):
-                                # Non-numeric inventory - skip restoration for service business
-                                has_cancel_numeric_inventory = False
-                                print(f"[DEBUG] Non-numeric cancel inventory: '{cancel_quantity_value}' - skipping restoration for service business")
-                        break
+            idx = find_product_row(inventory_data, product_name)
+            if idx is not None:
+                detected_cols = inventory_data["detected"][idx]
+                product_found = True
+                if "quantity" in detected_cols:
+                    # Safe integer conversion for cancellation restoration
+                    cancel_quantity_value = detected_cols["quantity"]["value"] or "0"
+                    try:
+                        current_stock = int(cancel_quantity_value)
+                        has_cancel_numeric_inventory = True
+                    except (ValueError, TypeError):
+                        # Non-numeric inventory - skip restoration for service business
+                        has_cancel_numeric_inventory = False
+                        logger.debug("Non-numeric cancel inventory: '%s' - skipping restoration for service business", cancel_quantity_value)
             
             if product_found and has_cancel_numeric_inventory:
                 # Restore inventory by adding back the cancelled quantity
                 new_stock = current_stock + quantity_to_restore
                 
-                print(f"[DEBUG] Restoring inventory: {current_stock} + {quantity_to_restore} = {new_stock}")
-                
-                # Update inventory
-                quantity_col = None
-                for col_letter, header in enumerate(inventory_data["headers"], start=1):
-                    if any(word in header.lower() for word in ["quantity", "qty", "stock"]):
-                        quantity_col = chr(64 + col_letter)
-                        break
+                logger.debug("Restoring inventory: %s + %s = %s", current_stock, quantity_to_restore, new_stock)
                 
-                if quantity_col and product_row_index > 0:
-                    range_name = f"{inventory_config['worksheet_name']}!{quantity_col}{product_row_index}"
-                    service.spreadsheets().values().update(
-                        spreadsheetId=inventory_config["workbook_id"],
-                        range=range_name,
-                        valueInputOption="RAW",
-                        body={"values": [[str(new_stock)]]}
-                    ).execute()
-                    print(f"[DEBUG] Inventory restored: {current_stock} -> {new_stock}")
+                if _write_inventory_qty(pending_writes, inventory_config, inventory_data, idx, new_stock):
+                    logger.debug("Inventory restore queued: %s -> %s", current_stock, new_stock)
         
         # Step 5: Update order status from 'Pending' to 'Cancelled'
-        orders_headers = orders_data["headers"]
-        status_col = None
-        
-        # Find the existing status column
-        for col_idx, header in enumerate(orders_headers):
-            if "status" in header.lower():
-                status_col = chr(65 + col_idx)  # A=0, B=1, etc.
-                break
+        status_col = orders_data["status_col_letter"]
         
         if status_col:
             # Update the existing status column to 'Cancelled'
-            range_name = f"{orders_config['worksheet_name']}!{status_col}{order_row_index}"
-            service.spreadsheets().values().update(
-                spreadsheetId=orders_config["workbook_id"],
-                range=range_name,
-                valueInputOption="RAW",
-                body={"values": [["Cancelled"]]}
-            ).execute()
-            print(f"[DEBUG] Order status updated from 'Pending' to 'Cancelled' in column {status_col}")
+            range_name = a1_cell(orders_config["worksheet_name"], status_col, order_row_index)
+            pending_writes.setdefault(orders_config["workbook_id"], []).append(
+                {"range": range_name, "values": [["Cancelled"]]}
+            )
+            logger.debug("Order status update from 'Pending' to 'Cancelled' queued for column %s", status_col)
         else:
-            print(f"[DEBUG] Warning: No Status column found in orders sheet")
+            logger.warning("No Status column found in orders sheet")
             # Still proceed with cancellation even if status column not found
+        
+        # Inventory restore + status change go out together (one call per workbook)
+        flush_value_writes(service, pending_writes)
+        invalidate_sheet_cache(inventory_config, orders_config)
         # Step 6: Return success response  
-        return json.dumps({
+        response = {
             "success": True,
             "message": f"Order {order_id} cancelled successfully",
             "order_id": order_id,
             "cancelled_details": order_details,
-            "inventory_restored": quantity_to_restore > 0,
-            "order_summary": f"""
-❌ ORDER CANCELLED SUCCESSFULLY!
-
-🆔 Cancelled Order: {order_id}
-📦 Product: {product_name}
-🔢 Quantity: {quantity_to_restore}
-👤 Customer: {order_details['customer_name']}
-
-✅ Order marked as 'Cancelled' and {quantity_to_restore} units restored to inventory!
-📋 Order preserved for business records."""
-        })
+            "inventory_restored": quantity_to_restore > 0
+        }
+        
+        if INCLUDE_SUMMARY:
+            response["order_summary"] = _CANCEL_SUMMARY_TMPL.format(
+                order_id=order_id,
+                product=product_name,
+                qty=quantity_to_restore,
+                customer=order_details["customer_name"]
+            )
+        
+        return response
         
     except Exception as e:
         logger.error(f"Order cancellation failed: {e}")
-        return json.dumps({
+        # A write may have partly gone through - don't serve pre-write data
+        invalidate_sheet_cache(inventory_config, orders_config)
+        return {
             "success": False,
             "error": "cancellation_failed",
             "details": str(e)
-        })
+        }
+    finally:
+        stock_locks.close()
+
+@mcp.tool()
+async def cancel_customer_order_tool(order_id: str) -> dict:
+    """
+    Cancel an existing customer order by ORDER ID and restore inventory.
+    - Marks order status as 'Cancelled' instead of deleting the row
+    - Restores full quantity back to inventory
+    - Preserves order history for business records and analytics
+    """
+    return await asyncio.to_thread(_cancel_customer_order, order_id)
 
 
 @mcp.tool()
 def say_hello(name: str) -> str:
 
     headers = get_http_headers()
-    print(headers)
+    logger.debug("Request headers: %s", headers)
     return f"Hello, {name}!, \nHeaders, {headers}"
 
 streamable_http_app = mcp.http_app()
+_mcp_app_lifespan = streamable_http_app.router.lifespan_context
+
+@contextlib.asynccontextmanager
+async def _app_lifespan(app):
+    async with _warm_up(), _mcp_app_lifespan(app):
+        yield
+
+streamable_http_app.router.lifespan_context = _app_lifespan
 
 if __name__ == "__main__":
     # Enable even more detailed MCP logging
-    import os
     os.environ["MCP_LOG_LEVEL"] = "DEBUG"
     
     # Enable JSON RPC message tracing
@@ -1327,11 +2125,28 @@ if __name__ == "__main__":
     
     port = 8010
 
+    # DEV=1 turns on auto-reload
+    dev_mode = os.getenv("DEV") == "1"
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        # The stock locks and the duplicate-order map live in one process: with
+        # several workers, concurrent orders could lose stock updates or be
+        # booked twice. Refuse until stock writes have a cross-process guard.
+        logger.error(
+            "WORKERS=%s is not supported: stock updates and duplicate-order checks "
+            "are only safe within one process. Starting a single worker.", workers
+        )
+        workers = 1
+
+    # uvicorn[standard] brings uvloop and httptools, which uvicorn uses automatically
+
     import uvicorn
     uvicorn.run(
         "server:streamable_http_app", 
         host="127.0.0.1", 
         port=port,
-        reload=True,
+        reload=dev_mode,
+        workers=workers,
+        backlog=2048,
         log_level="info"
     )
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+
+# server reads the OAuth client at import time; the helpers under test never use it
+os.environ.setdefault("GOOGLE_CLIENT_ID", "test-client-id")
+os.environ.setdefault("GOOGLE_CLIENT_SECRET", "test-client-secret")
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("header, field", [
+    ("Order ID", "order_id"),
+    ("Customer Name", "customer_name"),
+    ("Email Address", "customer_email"),
+    ("Product Price", "price"),
+    ("Total Price", "subtotal"),
+    ("Order Status", "status"),
+    ("Delivery Address", "customer_address"),
+    ("Payment Mode", "payment_mode"),
+    ("Customer Phone", None),
+    ("Delivery Date", None),
+    ("Order Date", None),
+])
+def test_header_field_words(header, field):
+    assert server._header_field(header) == field
+
+
+@pytest.mark.parametrize("header, field", [
+    ("OrderID", "order_id"),
+    ("OrderNo", "order_id"),
+    ("Order No.", "order_id"),
+    ("Order #", "order_id"),
+    ("ProductName", "product_name"),
+    ("UnitPrice", "price"),
+    ("Price(PKR)", "price"),
+    ("CustomerEmail", "customer_email"),
+    ("Quantity(pcs)", "quantity"),
+    ("Qty.", "quantity"),
+    ("TotalAmount", "subtotal"),
+    ("orderid", "order_id"),
+    ("customeremail", "customer_email"),
+    ("customerphone", None),
+])
+def test_header_field_camelcase_and_punctuation(header, field):
+    assert server._header_field(header) == field
+
+
+@pytest.mark.parametrize("value, price", [
+    ("1200", 1200.0),
+    ("PKR 1,200", 1200.0),
+    ("Rs. 1,200.50", 1200.5),
+    ("$3.99", 3.99),
+    ("-5", -5.0),
+    ("PKR -5", -5.0),
+    ("1.200,50", 1200.5),
+    ("", None),
+    ("free", None),
+])
+def test_parse_price(value, price):
+    assert server.parse_price(value) == price
+
+
+@pytest.mark.parametrize("index, letters", [(0, "A"), (25, "Z"), (26, "AA"), (701, "ZZ"), (702, "AAA")])
+def test_column_letter(index, letters):
+    assert server.column_letter(index) == letters
+
+
+def test_column_letter_rejects_negative_index():
+    with pytest.raises(ValueError):
+        server.column_letter(-1)
+
+
+def test_duplicate_order_expires_after_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(server, "_recent_orders", OrderedDict())
+    monkeypatch.setattr(server.time, "monotonic", lambda: clock[0])
+    assert not server._is_duplicate_order(b"order")
+    clock[0] += server._RECENT_TTL - 1
+    assert server._is_duplicate_order(b"order")
+    clock[0] += 2
+    assert not server._is_duplicate_order(b"order")
+
+
+def test_update_columns_one_column_per_field():
+    headers = ("Order ID", "Customer Name", "Email", "Delivery Address", "Payment Mode")
+    columns = server._sheet_schema(headers)["header_col_letters"]
+    update_data = {
+        "customer_name": "Ali", "customer": "Ali",
+        "customer_email": "ali@example.com", "email": "ali@example.com",
+        "customer_address": "Lahore", "address": "Lahore", "delivery_address": "Lahore",
+        "payment_mode": "COD", "payment_type": "COD", "payment": "COD",
+    }
+    assert server._match_update_columns(update_data, columns) == {
+        "customer_name": "Ali",
+        "email": "ali@example.com",
+        "delivery_address": "Lahore",
+        "payment_mode": "COD",
+    }
+
+
+def test_update_columns_exact_headers_first():
+    columns = server._sheet_schema(("Product", "Unit Price", "Qty"))["header_col_letters"]
+    update_data = {
+        "product_name": "Shirt", "product": "Shirt",
+        "price": "100", "unit_price": "100",
+        "quantity": "2", "qty": "2",
+        "category": "",
+    }
+    assert server._match_update_columns(update_data, columns) == {
+        "product": "Shirt", "unit_price": "100", "qty": "2"
+    }